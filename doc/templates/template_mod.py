@@ -41,15 +41,55 @@ class template_mod(InternalModule):
         #    rc('ANOTHER STRING'): self.other_handler_func
         #    }
         #
+        # Instead of just the handler, you may give (handler, fieldspec),
+        # where fieldspec maps field names to groups of the regex, e.g.
+        #    rc('Accepted (\S+) for (\S+)'): (self.handler_func,
+        #                                     {'method': 1, 'user': 2})
+        # and the handler gets them in linemap.fields, without having
+        # to search the message again.
+        #
         self.regex_map = {
         }
+        ##
+        # Optional. Regexes that only apply to lines logged by certain
+        # programs can be mapped to the program tag (or a tuple of tags),
+        # so they are not tried on lines from other programs. Only the
+        # tag at the start of the message is looked at, so only map
+        # regexes that could not match anywhere else in it. Regexes
+        # anchored like rc('^sshd\[') get their tag automatically.
+        #self.tag_map = {
+        #    some_regex: 'sshd'
+        #    }
+        #
+        ##
+        # Optional. Lines matched by regexes mapped to a batch handler
+        # are handed over a thousand or so at a time, saving a trip
+        # through the processing queue for every line. The batch handler
+        # returns the results for all of them added up; every line in
+        # the batch is taken as handled. InternalModule.handle_batch
+        # calls the handlers from regex_map, or you may write your own.
+        #self.batch_map = {
+        #    some_regex: self.handle_batch
+        #    }
+        #
+        ##
+        # Optional. If the module reads its rules from files, it may
+        # have them read and checked only when the files change; the
+        # result is kept in epylog's vardir and must be picklable. Raise
+        # the ruleset_version whenever _parse_rules changes:
+        #self.ruleset_version = 1
+        #rules = self.load_ruleset('template', [rules_file],
+        #                          self._parse_rules, rules_file)
+        #
 
     ##
     # Line-matching routines
     #
     def handler_func(self, linemap):
         ##
-        # linemap is a dictionary with the following members:
+        # linemap is an epylog.log.LineRecord with the following
+        # members, which can be read either as linemap.message or
+        # linemap['message'], like a dictionary:
         # line: the original, unadulterated line.
         # stamp: unix timestamp of the event
         # system: the reporting hostname
@@ -58,6 +98,10 @@ class template_mod(InternalModule):
         #             Most often this will be set to 1, but it
         #             can have other values as a result of unwrapping
         #             the "last message repeated" lines by epylog.
+        # regex: the regex from regex_map that matched this line.
+        # match: the match object of that regex.
+        # fields: the fields from the fieldspec given in regex_map,
+        #         or the named groups of the match if there was none.
         #
 
         ##
@@ -74,6 +118,18 @@ class template_mod(InternalModule):
         # SOLELY for analyzing the log string and doing network lookups.
         # All processing should be done in finalize stage.
         #
+        # With "executor = processes", the handlers run in worker
+        # processes, each with its own copy of the module, so anything
+        # they keep on self is not seen by the other workers or by
+        # finalize.
+        #
+        # self.gethost(ip) does not look up the name right away, but
+        # returns a token that is replaced with the name in the
+        # resultset before finalize. It may go into the result as it
+        # is, or as part of a string, but do not look into it. If the
+        # handlers need the names themselves, set self.defer_hosts = 0
+        # in __init__.
+        #
 
         ##
         # DO SOME STUFF HERE
@@ -175,6 +175,12 @@ class logins_mod(InternalModule):
                 except:
                     logger.put(0, 'Error compiling domain regex: %s' % domain)
                     logger.put(0, 'Check config for Logins module!')
+        ##
+        # Unless all domains are safe, or none are, the names are needed
+        # right away to tell which ones are.
+        #
+        for domain_re in self.safe_domains:
+            if domain_re.pattern != '.*': self.defer_hosts = 0
 
         self.failed_summary_only = opts.get('failed_summary_only', '0')
 
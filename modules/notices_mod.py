@@ -50,7 +50,14 @@ class notices_mod(InternalModule):
         enlist = []
         for en in enables.split(','): enlist.append(en.strip())
         
-        notice_dict = self._parse_notices(n_dist, n_loc, enlist)
+        ##
+        # Parsing the xml is kept in the vardir until the files change.
+        # Raise the version if it is parsed differently.
+        #
+        self.ruleset_version = 1
+        notice_dict = self.load_ruleset('notices', [n_dist, n_loc],
+                                        self._parse_notices, n_dist, n_loc,
+                                        enlist)
         if not notice_dict: return
         self._digest_notice_dict(notice_dict)
 
@@ -70,8 +77,7 @@ class notices_mod(InternalModule):
         sys, msg, mult = self.get_smm(linemap)
         regex = linemap['regex']
         crit, report = self.regex_dict[regex]
-        mo = regex.search(msg)
-        groups = mo.groups()
+        groups = linemap.match.groups()
         if groups:
             groups = self._resolver(groups)
             try: report = report % groups
@@ -71,17 +71,21 @@ class packets_mod(InternalModule):
         self.trojan_list_re = rc('^(\S*)\s+(.*)')
         self.etc_protocols_re = rc('^(\S*)\s+(\S*)')
 
-        svcdict = self._parse_etc_services()
-
         trojans = opts.get('trojan_list', '')
         self.systems_collapse = int(opts.get('systems_collapse', '10'))
         self.ports_collapse = int(opts.get('ports_collapse', '10'))
 
         self.trojan_warning_wrap = '<font color="red">%s</font>'
-        if trojans: svcdict = self._parse_trojan_list(trojans, svcdict)
-        self.svcdict = svcdict
-
-        self.protodict = self._parse_etc_protocols()
+        ##
+        # Parsing these is kept in the vardir until the files change.
+        # Raise the version if they are parsed differently.
+        #
+        self.ruleset_version = 1
+        sources = ['/etc/services', '/etc/protocols']
+        if trojans: sources.append(trojans)
+        self.svcdict, self.protodict = self.load_ruleset('packets', sources,
+                                                         self._parse_dicts,
+                                                         trojans)
 
         self.collapsed_ports_rep = '<font color="red">[%d&nbsp;ports]</font>'
         self.collapsed_hosts_rep = '<font color="red">[%d&nbsp;hosts]</font>'
@@ -92,6 +96,12 @@ class packets_mod(InternalModule):
         self.line_rep = '<tr%s><td valign="top" width="5%%">%d</td><td valign="top" width="50%%">%s</td><td valign="top" width="15%%">%s</td><td valign="top" width="15%%">%s</td><td valign="top" width="15%%">%s</td></tr>\n'
         self.flip = ' bgcolor="#dddddd"'
 
+    def _parse_dicts(self, trojans):
+        svcdict = self._parse_etc_services()
+        if trojans: svcdict = self._parse_trojan_list(trojans, svcdict)
+        protodict = self._parse_etc_protocols()
+        return (svcdict, protodict)
+
     def _parse_etc_protocols(self):
         try: fh = open('/etc/protocols', 'r')
         except:
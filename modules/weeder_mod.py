@@ -51,16 +51,56 @@ class weeder_mod(InternalModule):
         
         logger.put(5, 'weed_dist=%s' % weed_dist)
         logger.put(5, 'weed_local=%s' % weed_local)
-        weed = {}
         self.regex_map = {}
+        self.sections = {}
+        ##
+        # A line weeded by more than one section is counted for the one
+        # that comes first in the weed files, so the regexes are tried in
+        # that order and never reordered by their hits.
+        #
+        self.regex_order = []
         self.section_re = rc('^\s*\[(.*)\]\s*$')
         self.comment_re = rc('^\s*#')
         self.empty_re = rc('^\s*$')
+        self.backref_re = rc(r'\\[1-9]|\(\?P=')
+        ##
+        # The regexes of a section are merged into alternations with no
+        # more groups than this, as re only supports 100 of them.
+        #
+        self.max_groups = 90
+
+        self.report_wrap = '<table border="0" width="100%%" rules="cols" cellpadding="2">%s</table>\n'
+        self.report_line = '<tr%s><td valign="top" width="90%%">%s</td><td valign="top" width="10%%">%d</td></tr>\n'
+        self.flip = ' bgcolor="#dddddd"'
+
+        ##
+        # Reading and merging the rules is kept in the vardir until the
+        # weed files change. Raise the version if the rules are read or
+        # merged differently.
+        #
+        self.ruleset_version = 1
+        weed_files = [weed_dist, weed_local]
+        enable = opts.get('enable', 'ALL')
+        rules = self.load_ruleset('weeder', weed_files, self._get_rules,
+                                  weed_files, enable)
+        for regex_re, section in rules:
+            self.regex_map[regex_re] = self.do_weed
+            self.batch_map[regex_re] = self.handle_batch
+            self.sections[regex_re] = section
+            self.regex_order.append(regex_re)
 
-        for weedfile in [weed_dist, weed_local]:
-            try: weed = self._read_weed(open(weedfile), weed)
+    def _get_rules(self, weed_files, enable):
+        """
+        Read the weed files and return (regex, section) tuples for the
+        enabled sections.
+        """
+        logger = self.logger
+        weed = {}
+        order = []
+        for weedfile in weed_files:
+            try: weed = self._read_weed(open(weedfile), weed, order)
             except: logger.put(5, 'Error reading %s' % weedfile)
-        if not weed: return
+        if not weed: return []
 
         if 'REMOVE' in weed:
             removes = weed['REMOVE']
@@ -73,21 +113,60 @@ class weeder_mod(InternalModule):
                         for regex in regexes:
                             if regex != remove: weed[key].append(regex)
         
-        enable = opts.get('enable', 'ALL').split(',')
+        enable = enable.split(',')
         
         if 'ADD' in weed: enable.append('ADD')
-        if enable[0] == 'ALL': enable = weed.keys()
+        if enable[0] == 'ALL': enable = order
+        rules = []
         for key in enable:
             key = key.strip()
-            regexes = weed.get(key, [])
-            for regex in regexes:
-                try: regex_re = rc(regex)
-                except:
-                    logger.put(5, 'Error compiling regex "%s"' % regex)
-                    continue
-                self.regex_map[regex_re] = self.do_weed
-        
-    def _read_weed(self, fh, weed):
+            rules.extend(self._merge_section(key, weed.get(key, [])))
+        return rules
+
+    def _merge_section(self, section, regexes):
+        """
+        Merge the regexes of a section into as few alternations as the
+        limit on groups allows, so that a line not weeded only pays for a
+        few searches. Regexes with flags or backreferences of their own
+        are kept apart, as they would not work inside an alternation.
+        """
+        logger = self.logger
+        rc = re.compile
+        rules = []
+        chunk = []
+        groups = 0
+        for regex in regexes:
+            try: regex_re = rc(regex)
+            except:
+                logger.put(5, 'Error compiling regex "%s"' % regex)
+                continue
+            if regex_re.flags or self.backref_re.search(regex):
+                rules.append((regex_re, section))
+                continue
+            if chunk and groups + regex_re.groups > self.max_groups:
+                rules.extend(self._merge_chunk(chunk, section))
+                chunk = []
+                groups = 0
+            chunk.append(regex)
+            groups += regex_re.groups
+        if chunk: rules.extend(self._merge_chunk(chunk, section))
+        return rules
+
+    def _merge_chunk(self, regexes, section):
+        if len(regexes) == 1: return [(re.compile(regexes[0]), section)]
+        alternatives = []
+        for regex in regexes: alternatives.append('(?:%s)' % regex)
+        try: chunk_re = re.compile('|'.join(alternatives))
+        except:
+            self.logger.put(5, 'Error merging the regexes of [%s]' % section)
+            rules = []
+            for regex in regexes: rules.append((re.compile(regex), section))
+            return rules
+        self.logger.put(5, 'Merged %d regexes of [%s]'
+                        % (len(regexes), section))
+        return [(chunk_re, section)]
+
+    def _read_weed(self, fh, weed, order):
         section = 'default'
         while 1:
             line = fh.readline()
@@ -98,17 +177,43 @@ class weeder_mod(InternalModule):
             if mo: section = mo.group(1)
             else:
                 try: weed[section].append(line.strip())
-                except KeyError: weed[section] = [line.strip()]
+                except KeyError:
+                    weed[section] = [line.strip()]
+                    order.append(section)
         return weed
             
     ##
     # Line-matching routines
     #
     def do_weed(self, linemap):
-        return {1: linemap['multiplier']}
+        section = self.sections[linemap['regex']]
+        return {(section,): linemap['multiplier']}
+
+    def handle_batch(self, linemaps):
+        sections = self.sections
+        counts = {}
+        for linemap in linemaps:
+            section = sections[linemap.regex]
+            counts[section] = counts.get(section, 0) + linemap.multiplier
+        results = {}
+        for section, mult in counts.items(): results[(section,)] = mult
+        return results
 
     def finalize(self, rs):
-        report = '<p>Total messages weeded: <b>%d</b></p>' % rs[1]
+        total = 0
+        sections = []
+        for restuple, mult in rs.items():
+            total += mult
+            sections.append((mult, restuple[0]))
+        sections.sort(lambda a, b: cmp(b[0], a[0]) or cmp(a[1], b[1]))
+        report = '<p>Total messages weeded: <b>%d</b></p>\n' % total
+        lines = ''
+        flipper = ''
+        for mult, section in sections:
+            if flipper: flipper = ''
+            else: flipper = self.flip
+            lines += self.report_line % (flipper, section, mult)
+        report += self.report_wrap % lines
         return report
 
 if __name__ == '__main__':
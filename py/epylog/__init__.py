@@ -27,14 +27,31 @@ This module contains the main classes and methods for Epylog.
 
 import ConfigParser
 import exceptions
+import math
 import os
 import shutil
 import tempfile
 import re
+import string
 import threading
 import pwd
 import socket
 import sys
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from collections import deque
+except ImportError:
+    ##
+    # Must be python < 2.4
+    #
+    class deque(list):
+        def popleft(self): return self.pop(0)
 
 if 'mkdtemp' not in dir(tempfile):
     ##
@@ -44,16 +61,56 @@ if 'mkdtemp' not in dir(tempfile):
     import mytempfile as tempfile
 
 from report import Report
-from module import Module
-from log import LogTracker
+from module import Module, Prefilter, MatchCache
+from log import LogTracker, LogWatcher
+from log import load_state, save_state, REGEXSTATS_FILE, STATE_EXPIRE
+from log import RULESET_FILE
+
+try:
+    from hashlib import md5 as md5_new
+except ImportError:
+    ##
+    # Must be python < 2.5
+    #
+    from md5 import new as md5_new
 
 VERSION = 'Epylog-1.0.7'
 CHUNK_SIZE = 8192
 GREP_LINES = 10000
-QUEUE_LIMIT = 500
+QUEUE_BATCH = 100
+QUEUE_HIGH = 2000
+QUEUE_LOW = 1000
+FILTER_FLUSH = 1000
+LINE_BATCH = 1000
+REORDER_BATCHES = 10
+GZIP_CHECKPOINT = 4*1024*1024
+INFLATE_THREADS = 4
+STAMPINDEX_SPACING = 64*1024
+STAMPINDEX_SAMPLES = 4096
+PREFILTER_MIN = 3
+THREADS_MAX = 50
+CALIBRATE_BATCHES = 5
+CPU_BUSY = 0.8
+RESOLVE_THREADS = 16
+STOP_CHECK = 1
+RESOLVE_TIMEOUT = 3
+RESOLVE_BUDGET = 60
+HOST_TOKEN = '\x00%s\x00'
+HOST_TOKEN_RE = re.compile('\x00([^\x00]*)\x00')
+MATCH_CACHE_SIZE = 4096
+SHAPE_MASK = string.maketrans(string.digits, '0' * len(string.digits))
 LOG_SPLIT_RE = re.compile(r'(.{15,15})\s+(\S+)\s+(.*)$')
 SYSLOG_NG_STRIP = re.compile(r'.*[@/]')
 MESSAGE_REPEATED_RE = re.compile(r'last message repeated (\S+) times')
+PROGRAM_TAG_RE = re.compile(r'[^\s\[:]+')
+PROGRAM_TAG_END = '[: \t\n\r\f\v'
+
+def cpu_count():
+    """
+    Return how many processors are online, or 1 if that cannot be told.
+    """
+    try: return max(os.sysconf('SC_NPROCESSORS_ONLN'), 1)
+    except (AttributeError, ValueError, OSError): return 1
 
 class FormatError(exceptions.Exception):
     """
@@ -212,18 +269,103 @@ class Epylog:
         except: self.multimatch = 0
         logger.put(5, 'multimatch=%d' % self.multimatch)
         ##
-        # Get threading pref
+        # Get threading pref. 0 means "auto": start with one thread for
+        # each CPU and see how well they keep up.
         #
-        try:
-            threads = config.getint('main', 'threads')
-            if threads < 2:
+        try: threads = config.get('main', 'threads').strip().lower()
+        except: threads = 'auto'
+        if threads == 'auto': self.threads = 0
+        else:
+            try: threads = int(threads)
+            except ValueError:
+                logger.put(0, 'Threads set to "%s", using auto' % threads)
+                threads = 0
+            if threads == 1:
                 logger.put(0, 'Threads set to less than 2, fixing')
                 threads = 2
-            self.threads = threads
-        except:
-            self.threads = 50
+            self.threads = max(threads, 0)
         logger.put(5, 'threads=%d' % self.threads)
         ##
+        # Get executor prefs
+        #
+        try: self.executor = config.get('main', 'executor').strip().lower()
+        except: self.executor = 'threads'
+        if self.executor not in ('threads', 'processes'):
+            logger.put(0, 'Unknown executor "%s", using threads'
+                       % self.executor)
+            self.executor = 'threads'
+        if self.executor == 'processes' and not hasattr(os, 'fork'):
+            logger.put(0, 'Cannot fork on this platform, using threads')
+            self.executor = 'threads'
+        try: processes = config.get('main', 'processes').strip().lower()
+        except: processes = 'auto'
+        if processes == 'auto': self.processes = 0
+        else:
+            try: self.processes = max(int(processes), 0)
+            except ValueError:
+                logger.put(0, 'Processes set to "%s", using auto' % processes)
+                self.processes = 0
+        try: self.calibrate = config.getboolean('main', 'calibrate')
+        except: self.calibrate = 1
+        logger.put(5, 'executor=%s' % self.executor)
+        logger.put(5, 'processes=%d' % self.processes)
+        logger.put(5, 'calibrate=%d' % self.calibrate)
+        ##
+        # Get prefs for the processing queue
+        #
+        try: self.queue_batch = max(config.getint('main', 'queue_batch'), 1)
+        except: self.queue_batch = QUEUE_BATCH
+        try: self.queue_high = max(config.getint('main', 'queue_high'), 1)
+        except: self.queue_high = QUEUE_HIGH
+        try: self.queue_low = config.getint('main', 'queue_low')
+        except: self.queue_low = min(QUEUE_LOW, self.queue_high / 2)
+        if self.queue_low >= self.queue_high or self.queue_low < 0:
+            logger.put(0, 'queue_low must be below queue_high, fixing')
+            self.queue_low = self.queue_high / 2
+        logger.put(5, 'queue_batch=%d' % self.queue_batch)
+        logger.put(5, 'queue_high=%d' % self.queue_high)
+        logger.put(5, 'queue_low=%d' % self.queue_low)
+        ##
+        # Get sharding pref
+        #
+        try:
+            shards = config.getint('main', 'shards')
+            if shards < 1:
+                logger.put(0, 'Shards set to less than 1, fixing')
+                shards = 1
+            self.shards = shards
+        except:
+            self.shards = 1
+        if self.shards > 1 and not hasattr(os, 'fork'):
+            logger.put(0, 'Cannot fork on this platform, not sharding')
+            self.shards = 1
+        logger.put(5, 'shards=%d' % self.shards)
+        ##
+        # Get prefs for resolving the hosts in the results
+        #
+        try: threads = max(config.getint('main', 'resolve_threads'), 1)
+        except: threads = RESOLVE_THREADS
+        try: timeout = config.getfloat('main', 'resolve_timeout')
+        except: timeout = RESOLVE_TIMEOUT
+        try: budget = config.getfloat('main', 'resolve_budget')
+        except: budget = RESOLVE_BUDGET
+        logger.put(5, 'resolve_threads=%d' % threads)
+        logger.put(5, 'resolve_timeout=%s' % timeout)
+        logger.put(5, 'resolve_budget=%s' % budget)
+        self.resolver = HostResolver(threads, timeout, budget, logger)
+        ##
+        # Get prefs for following the logs
+        #
+        try: self.interval = config.getint('daemon', 'interval') * 60*60
+        except: self.interval = 24*60*60
+        try: self.poll = config.getint('daemon', 'poll')
+        except: self.poll = 60
+        logger.put(5, 'interval=%d' % self.interval)
+        logger.put(5, 'poll=%d' % self.poll)
+        self.watcher = None
+        self.resultsets = {}
+        self.config = config
+        ##
         # Initialize the Report object
         #
         logger.puthang(3, 'Initializing the Report')
@@ -301,6 +443,8 @@ class Epylog:
                        % (module.name, module.priority))
             if module.is_internal(): self.imodules.append(module)
             else: self.emodules.append(module)
+        self.prefilter = None
+        self.match_caches = {}
         logger.put(5, '<Epylog.__init__')
 
     def process_modules(self):
@@ -313,21 +457,84 @@ class Epylog:
         if len(self.imodules):
             self._process_internal_modules()
         if len(self.emodules):
-            logger.puthang(3, 'Processing external modules')
-            for module in self.emodules:
-                logger.puthang(1, 'Processing module "%s"' % module.name)
-                try:
-                    module.invoke_external_module(self.cfgdir)
-                except ModuleError, e:
-                    ##
-                    # Module execution error!
-                    # Do not die, but provide a visible warning.
-                    #
-                    logger.put(0, str(e))
-                logger.endhang(1, 'done')
-            logger.endhang(3)
+            self._process_external_modules()
         logger.put(5, '<Epylog.process_modules')
 
+    def follow_logs(self):
+        """
+        Used when following the logs: run the lines added to the logs
+        since the last call through the internal modules, adding to the
+        results collected so far. The first call processes the whole
+        offset range. Returns the number of logs that had new lines.
+        """
+        logger = self.logger
+        logger.put(5, '>Epylog.follow_logs')
+        ##
+        # Logs used only by external modules still need their ranges
+        # extended.
+        #
+        oranges = []
+        for log in self.logtracker.logs:
+            orange = log.refresh()
+            if orange is not None: oranges.append((log.entry, orange))
+        self._load_internal_modules()
+        logmap = self._get_logmap()
+        jobs = []
+        for entry, orange in oranges:
+            if entry in logmap: jobs.append((entry, orange))
+        if jobs:
+            upfh = open(self.unparsed, 'a')
+            try:
+                resultsets = self._process_logs(logmap, jobs, upfh)
+            finally:
+                upfh.close()
+            for module, rs in resultsets.items():
+                try: self.resultsets[module].add_resultset(rs)
+                except KeyError: self.resultsets[module] = rs
+        logger.put(5, '<Epylog.follow_logs')
+        return len(jobs)
+
+    def wait_for_logs(self, timeout, stopped=None):
+        """
+        Used when following the logs: wait until there is something new
+        in them, but no longer than timeout seconds, or until stopped(),
+        if given, returns true.
+        """
+        if self.watcher is None:
+            self.watcher = LogWatcher(self.logtracker.get_filenames(),
+                                      self.poll, self.logger)
+        return self.watcher.wait(timeout, stopped)
+
+    def finalize_modules(self):
+        """
+        Used when following the logs: let the internal modules make their
+        reports out of the results collected by follow_logs(), and run
+        the external modules. After this the report can be made.
+        """
+        logger = self.logger
+        logger.put(5, '>Epylog.finalize_modules')
+        if len(self.imodules):
+            self._finalize_internal_modules(self.resultsets)
+        if len(self.emodules):
+            self._process_external_modules()
+        logger.put(5, '<Epylog.finalize_modules')
+
+    def start_new_period(self):
+        """
+        Used when following the logs: start collecting for the next
+        report where the last one ended.
+        """
+        logger = self.logger
+        logger.put(5, '>Epylog.start_new_period')
+        for log in self.logtracker.logs: log.start_new_range()
+        for module in self.modules: module.restart()
+        self.prefilter = None
+        self.match_caches = {}
+        self.resultsets = {}
+        open(self.unparsed, 'w').close()
+        self.report = Report(self.config, logger)
+        logger.put(5, '<Epylog.start_new_period')
+
     def make_report(self):
         """
         Create the report based on the result of the Epylog run.
@@ -376,6 +583,8 @@ class Epylog:
             unparsed = self._get_unparsed()
         else: unparsed = None
         self.report.publish(rawfh, unparsed)
+        rawfh.close()
+        os.unlink(rawfh.name)
         logger.put(5, '<Epylog.publish_report')
         
     def cleanup(self):
@@ -406,63 +615,295 @@ class Epylog:
         logger.put(3, 'Collecting logfiles used by internal modules')
         upfh = open(self.unparsed, 'w')
         logger.put(3, 'Opened unparsed strings file in "%s"' % self.unparsed)
+        self._load_internal_modules()
+        logmap = self._get_logmap()
+        if self.shards > 1:
+            resultsets = self._process_shards(logmap, upfh)
+        else:
+            jobs = []
+            for entry in logmap.keys(): jobs.append((entry, None))
+            resultsets = self._process_logs(logmap, jobs, upfh)
+        upfh.close()
+        self._finalize_internal_modules(resultsets)
+        logger.endhang(1)
+        logger.put(5, '<Epylog._process_internal_modules')
+
+    def _load_internal_modules(self):
+        """
+        Import and initialize the internal modules that have something
+        to process in their logs, and build the prefilter for them.
+        Modules whose logs all have empty ranges are not even imported,
+        and make no report.
+        """
+        logger = self.logger
+        logger.put(5, '>Epylog._load_internal_modules')
+        loaded = 0
+        for module in self.imodules[:]:
+            if module.epymod is not None: continue
+            empty = 1
+            for log in module.logs:
+                if not log.is_range_empty():
+                    empty = 0
+                    break
+            if empty:
+                logger.put(3, 'Nothing to process for module "%s", '
+                           'not loading it' % module.name)
+                continue
+            logger.puthang(3, 'Loading module "%s"' % module.name)
+            try:
+                module.load()
+                loaded = 1
+            except ModuleError, e:
+                logger.put(0, 'Module Error: %s' % e)
+                logger.put(0, 'Module "%s" disabled' % module.name)
+                self.modules.remove(module)
+                self.imodules.remove(module)
+            logger.endhang(3)
+        if loaded or self.prefilter is None:
+            logger.puthang(3, 'Building the prefilter for internal modules')
+            self.prefilter = Prefilter(self.imodules, logger)
+            logger.endhang(3)
+            self.match_caches = {}
+        logger.put(5, '<Epylog._load_internal_modules')
+
+    def _get_logmap(self):
+        """
+        Return a dict mapping the log entries to the loaded internal
+        modules interested in them.
+        """
+        logger = self.logger
         logmap = {}
         for module in self.imodules:
+            if module.epymod is None: continue
             for log in module.logs:
                 try: logmap[log.entry].append(module)
                 except KeyError: logmap[log.entry] = [module]
         logger.put(5, 'logmap follows')
         logger.put(5, logmap)
-        pq = ProcessingQueue(QUEUE_LIMIT, logger)
+        return logmap
+
+    def _finalize_internal_modules(self, resultsets):
+        """
+        Have the internal modules make their reports out of the
+        resultsets.
+        """
+        logger = self.logger
+        logger.put(5, '>Epylog._finalize_internal_modules')
+        self.resolver.resolve(resultsets)
+        logger.puthang(1, 'Finished all matching, now finalizing')
+        for module in self.imodules:
+            logger.puthang(1, 'Finalizing "%s"' % module.name)
+            try:
+                rs = resultsets[module]
+                try:
+                    module.finalize_processing(rs)
+                except Exception, e:
+                    msg = ('Module %s crashed in finalize stage: %s' % 
+                           (module.name, e))
+                    logger.put(0, msg)
+                    module.no_report()
+            except KeyError:
+                module.no_report()
+            logger.endhang(1)
+        logger.endhang(1)
+        self._store_regex_stats()
+        logger.put(5, '<Epylog._finalize_internal_modules')
+
+    def _store_regex_stats(self):
+        """
+        Store how often the regexes of the internal modules matched, so
+        the next run can start with the most useful ones. The counts of
+        the previous runs are halved every time, so the order can change
+        along with the logs.
+        """
+        logger = self.logger
+        logger.put(5, '>Epylog._store_regex_stats')
+        ##
+        # Only the modules whose regexes can be reordered count the hits.
+        #
+        modules = []
+        for module in self.imodules:
+            if getattr(module, 'order_safe', 0): modules.append(module)
+        if not modules:
+            logger.put(5, '<Epylog._store_regex_stats')
+            return
+        stats = load_state(self.vardir, REGEXSTATS_FILE, logger)
+        if not isinstance(stats, dict): stats = {}
+        now = int(time.time())
+        for key, value in stats.items():
+            if now - value[1] > STATE_EXPIRE: del stats[key]
+        for module in modules:
+            ##
+            # Modules not loaded this time have nothing to add.
+            #
+            if not module.match_list: continue
+            try: counts = stats[module.executable][0]
+            except (KeyError, TypeError, IndexError): counts = {}
+            newcounts = {}
+            for key, count in counts.items():
+                if count > 1: newcounts[key] = count / 2
+            for key, count in module.get_hits().items():
+                newcounts[key] = newcounts.get(key, 0) + count
+            stats[module.executable] = (newcounts, now)
+        save_state(self.vardir, REGEXSTATS_FILE, stats, logger)
+        logger.put(5, '<Epylog._store_regex_stats')
+
+    def _process_external_modules(self):
+        """
+        Invoke the external modules.
+        """
+        logger = self.logger
+        logger.put(5, '>Epylog._process_external_modules')
+        logger.puthang(3, 'Processing external modules')
+        for module in self.emodules:
+            logger.puthang(1, 'Processing module "%s"' % module.name)
+            try:
+                module.invoke_external_module(self.cfgdir)
+            except ModuleError, e:
+                ##
+                # Module execution error!
+                # Do not die, but provide a visible warning.
+                #
+                logger.put(0, str(e))
+            logger.endhang(1, 'done')
+        logger.endhang(3)
+        logger.put(5, '<Epylog._process_external_modules')
+
+    def _process_logs(self, logmap, jobs, upfh):
+        """
+        Match the lines of the logs against internal modules and run the
+        handlers in the processing threads. The jobs are (entry, orange)
+        tuples, where orange is either one of the ranges returned by
+        Log.get_shards or None for the whole range. Returns a dict with
+        resultsets for each module.
+        """
+        logger = self.logger
+        logger.put(5, '>Epylog._process_logs')
+        ##
+        # Shards are processed side by side, so their progress bars would
+        # only get in each other's way.
+        #
+        progress = 1
+        for entry, orange in jobs:
+            if orange is not None: progress = 0
+        prefilter = self.prefilter
+        pq = ProcessingQueue(self.queue_batch, self.queue_high,
+                             self.queue_low, logger)
         logger.put(3, 'Starting the processing threads')
+        if self.executor == 'processes': size = self.processes
+        else: size = self.threads
+        calibrating = 0
+        if not size:
+            size = cpu_count()
+            calibrating = self.calibrate
         threads = []
+        started = time.time()
+        cputime = os.times()
+        read = 0
         try:
-            while 1:
-                t = ConsumerThread(pq, logger)
-                t.start()
-                threads.append(t)
-                if len(threads) > self.threads: break
-            for entry in logmap.keys():
+            self._start_workers(pq, threads, size)
+            for entry, orange in jobs:
                 log = self.logtracker.getlog(entry)
                 if log.is_range_empty(): continue
+                modules = logmap[entry]
+                cache = self.match_caches.get(entry)
+                if cache is None:
+                    cache = MatchCache(MATCH_CACHE_SIZE, logger)
+                    self.match_caches[entry] = cache
                 matched = 0
                 lines = 0
-                while 1:
-                    logger.put(3, 'Getting next line from "%s"' % entry)
-                    try:
-                        linemap = log.nextline()
-                    except FormatError, e:
-                        logger.put(5, 'Writing the line to unparsed')
-                        upfh.write(str(e))
-                        continue
-                    except OutOfRangeError: break
-                    lines += 1
-                    logger.put(5, 'We have the following:')
-                    logger.put(5, 'line=%s' % linemap['line'])
-                    logger.put(5, 'stamp=%d' % linemap['stamp'])
-                    logger.put(5, 'system=%s' % linemap['system'])
-                    logger.put(5, 'message=%s' % linemap['message'])
-                    logger.put(5, 'multiplier=%d' % linemap['multiplier'])
-                    match = 0
-                    for module in logmap[entry]:
-                        logger.put(5, 'Matching module "%s"' % module.name)
-                        message = linemap['message']
-                        handler, regex = module.message_match(message)
-                        linemap['regex'] = regex
-                        if handler is not None:
-                            match = 1
-                            pq.put_linemap(linemap, handler, module)
-                            if not self.multimatch:
-                                logger.put(5, 'multimatch is not set')
-                                logger.put(5, 'Not matching other modules')
-                                break
-                    matched += match
-                    if not match:
-                        logger.put(5, 'Writing the line to unparsed')
-                        upfh.write(linemap['line'])
-                bartitle = log.entry
-                message = '%d of %d lines parsed' % (matched, lines)
-                logger.endbar(1, bartitle, message)
+                batches = 0
+                for linemaps in log.iterlines(LINE_BATCH, orange, progress):
+                    batches += 1
+                    if batches % REORDER_BATCHES == 0:
+                        changed = 0
+                        for module in modules:
+                            if module.reorder(): changed = 1
+                        if changed: cache.clear()
+                    pending = {}
+                    for linemap in linemaps:
+                        if linemap.message is None:
+                            logger.put(5, 'Writing the line to unparsed')
+                            upfh.write(linemap.line)
+                            continue
+                        lines += 1
+                        if logger.loglevel >= 5:
+                            ##
+                            # Don't make the stamp unless we print it.
+                            #
+                            logger.put(5, 'We have the following:')
+                            logger.put(5, 'line=%s' % linemap.line)
+                            logger.put(5, 'stamp=%d' % linemap.stamp)
+                            logger.put(5, 'system=%s' % linemap.system)
+                            logger.put(5, 'message=%s' % linemap.message)
+                            logger.put(5, 'multiplier=%d' % linemap.multiplier)
+                        match = 0
+                        message = linemap.message
+                        shape = message.translate(SHAPE_MASK)
+                        cached = cache.get(shape)
+                        if cached is None: found = prefilter.scan(message)
+                        shapable = 1
+                        matches = []
+                        for i in range(len(modules)):
+                            module = modules[i]
+                            logger.put(5, 'Matching module "%s"' % module.name)
+                            if cached is None:
+                                handler, mo, fieldspec = module.message_match(
+                                    message, found)
+                                if mo is None: matches.append(None)
+                                elif mo.re in module.shape_sensitive:
+                                    shapable = 0
+                                else: matches.append(mo.re)
+                            elif i < len(cached):
+                                handler, mo, fieldspec = module.shape_match(
+                                    message, cached[i])
+                            else:
+                                handler, mo, fieldspec = module.message_match(
+                                    message)
+                            if handler is not None:
+                                ##
+                                # With multimatch, the record handed to
+                                # the previous module keeps its own match.
+                                #
+                                if match: linemap = linemap.copy()
+                                linemap.set_match(mo, fieldspec)
+                                match = 1
+                                batch = module.batch_map.get(mo.re)
+                                if batch is None:
+                                    pq.put_linemap(linemap, handler, module)
+                                else:
+                                    try:
+                                        pending[(module, batch)].append(
+                                            linemap)
+                                    except KeyError:
+                                        pending[(module, batch)] = [linemap]
+                                if not self.multimatch:
+                                    logger.put(5, 'multimatch is not set')
+                                    logger.put(5, 'Not matching other modules')
+                                    break
+                        if cached is None and shapable:
+                            cache.put(shape, tuple(matches))
+                        matched += match
+                        if not match:
+                            logger.put(5, 'Writing the line to unparsed')
+                            upfh.write(linemap.line)
+                    for (module, batch), batched in pending.items():
+                        pq.put_batch(batched, batch, module)
+                    pq.flush()
+                    read += 1
+                    if calibrating and read >= CALIBRATE_BATCHES:
+                        if self._calibrate(pq, threads, started, cputime):
+                            calibrating = 0
+                if progress:
+                    bartitle = log.entry
+                    message = '%d of %d lines parsed' % (matched, lines)
+                    logger.endbar(1, bartitle, message)
+                else:
+                    logger.put(3, '%s: %d of %d lines parsed' %
+                               (log.entry, matched, lines))
+                logger.put(1, '%s: match cache: %d hits, %d misses, '
+                           '%d evictions' % (log.entry, cache.hits,
+                                             cache.misses, cache.evictions))
         finally:
             logger.put(3, 'Notifying the threads that they may die now')
             pq.tell_threads_to_quit(threads)
@@ -470,105 +911,366 @@ class Epylog:
             bartotal = len(threads)
             bardone = 1
             for t in threads:
-                logger.progressbar(1, bartitle, bardone, bartotal)
+                if progress: logger.progressbar(1, bartitle, bardone, bartotal)
                 t.join()
                 bardone += 1
-            logger.endbar(1, bartitle, 'all threads done')
-        upfh.close()
-        logger.puthang(1, 'Finished all matching, now finalizing')
-        for module in self.imodules:
-            logger.puthang(1, 'Finalizing "%s"' % module.name)
+            if progress: logger.endbar(1, bartitle, 'all threads done')
+            pq.collect(threads)
+            pq.put_stats(threads)
+        logger.put(5, '<Epylog._process_logs')
+        return pq.resultsets
+
+    def _start_workers(self, pq, threads, count):
+        """
+        Start "count" more processing threads, each with a worker
+        process if the executor is "processes", and add them to the
+        list of threads.
+        """
+        logger = self.logger
+        new = []
+        for i in range(count):
+            if self.executor == 'processes':
+                ##
+                # The workers are forked with whatever modules are
+                # loaded now, so they have to be started anew for every
+                # run of the logs.
+                #
+                try: t = ConsumerProcess(pq, self.imodules, threads + new,
+                                         logger)
+                except OSError, e:
+                    logger.put(0, 'Could not start a worker process: %s' % e)
+                    if threads or new: break
+                    t = ConsumerThread(pq, logger)
+            else: t = ConsumerThread(pq, logger)
+            new.append(t)
+        ##
+        # A worker forked while the threads run could be left holding a
+        # lock one of them had, e.g. for stdout, so all of them are
+        # forked before any thread is started.
+        #
+        for t in new:
+            t.start()
+            threads.append(t)
+
+    def _calibrate(self, pq, threads, started, cputime):
+        """
+        Work out how many processing threads it takes to keep up with
+        the matching, from how long the handlers took for each line so
+        far and how long matching took, and start or retire some. Under
+        one interpreter, more threads only help if the handlers spend
+        their time waiting, e.g. for name lookups, so the threads are
+        only added if the CPU was not kept busy. Threads with worker
+        processes are only retired. Returns 0 if nothing was handled
+        yet to tell.
+        """
+        logger = self.logger
+        logger.put(5, '>Epylog._calibrate')
+        busy = 0.0
+        handled = 0
+        for t in threads:
+            busy += t.busy
+            handled += t.lines
+        elapsed = time.time() - started
+        matching = elapsed - pq.put_wait
+        if not handled or not pq.lines or matching <= 0:
+            logger.put(5, '<Epylog._calibrate')
+            return 0
+        cost = busy / handled
+        rate = matching / pq.lines
+        needed = int(math.ceil(cost / rate))
+        ##
+        # Workers are never forked now that the threads are running, see
+        # _start_workers, so there only ever are fewer of them.
+        #
+        if self.executor == 'processes': limit = len(threads)
+        else:
+            now = os.times()
+            used = now[0] + now[1] - cputime[0] - cputime[1]
+            if used < elapsed * CPU_BUSY: limit = THREADS_MAX
+            else: limit = len(threads)
+        needed = max(1, min(needed, limit))
+        logger.put(2, 'Handlers take %.3fms a line, matching %.3fms a '
+                   'line: %d processing threads needed, %d running'
+                   % (cost * 1000, rate * 1000, needed, len(threads)))
+        if needed > len(threads):
+            self._start_workers(pq, threads, needed - len(threads))
+        elif needed < len(threads):
+            pq.retire_threads(len(threads) - needed)
+        logger.put(5, '<Epylog._calibrate')
+        return 1
+
+    def _process_shards(self, logmap, upfh):
+        """
+        Split the range of every log into shards and process each of
+        them in a forked process with its own copy of the modules. The
+        results, filtered and unparsed strings are collected afterwards,
+        in the order the shards appear in the logs.
+        """
+        logger = self.logger
+        logger.put(5, '>Epylog._process_shards')
+        jobs = []
+        for entry in logmap.keys():
+            log = self.logtracker.getlog(entry)
+            if log.is_range_empty(): continue
+            for orange in log.get_shards(self.shards):
+                jobs.append((entry, orange))
+        logger.put(3, 'Processing %d shards in up to %d processes'
+                   % (len(jobs), self.shards))
+        ##
+        # Anything still in the buffers would be written out by the
+        # children as well.
+        #
+        sys.stdout.flush()
+        upfh.flush()
+        for module in self.imodules: module.filtfh.flush()
+        children = {}
+        failed = []
+        bartitle = 'Processing shards'
+        bardone = 0
+        for i in range(len(jobs)):
+            while len(children) >= self.shards:
+                failed += self._reap_shard(children)
+                bardone += 1
+                logger.progressbar(1, bartitle, bardone, len(jobs))
+            pid = os.fork()
+            if pid == 0: self._run_shard(i, jobs[i], logmap)
+            children[pid] = i
+        while children:
+            failed += self._reap_shard(children)
+            bardone += 1
+            logger.progressbar(1, bartitle, bardone, len(jobs))
+        logger.endbar(1, bartitle, '%d shards done' % len(jobs))
+        logger.put(3, 'Collecting the shard results')
+        resultsets = {}
+        for entry in logmap.keys():
+            log = self.logtracker.getlog(entry)
+            if log.is_range_empty(): continue
+            log.load_last_messages()
+        for i in range(len(jobs)):
+            entry, orange = jobs[i]
+            if i in failed: continue
+            fh = open(self._shard_file(i, 'UNPARSED'))
+            shutil.copyfileobj(fh, upfh)
+            fh.close()
+            for modix in range(len(self.imodules)):
+                module = self.imodules[modix]
+                filtfile = self._shard_file(i, '%d.FILTER' % modix)
+                if not os.access(filtfile, os.R_OK): continue
+                fh = open(filtfile)
+                shutil.copyfileobj(fh, module.filtfh)
+                fh.close()
+            fh = open(self._shard_file(i, 'RESULTS'), 'rb')
+            results, last_messages, hits = pickle.load(fh)
+            fh.close()
+            for modix, rs in results.items():
+                module = self.imodules[modix]
+                try: resultsets[module].add_resultset(rs)
+                except KeyError: resultsets[module] = rs
+            for modix, modhits in hits.items():
+                self.imodules[modix].add_hits(modhits)
+            ##
+            # Shards come in log order, so the later ones know better
+            # what the last message from each system was.
+            #
+            log = self.logtracker.getlog(entry)
+            log.last_messages.update(last_messages)
+        for entry in logmap.keys():
+            log = self.logtracker.getlog(entry)
+            log.last_complete = 1
+            for i in failed:
+                if jobs[i][0] == entry: log.last_complete = 0
+        logger.put(5, '<Epylog._process_shards')
+        return resultsets
+
+    def _reap_shard(self, children):
+        """
+        Wait for one of the shard processes to exit. Returns a list with
+        the index of the shard if it did not finish successfully.
+        """
+        logger = self.logger
+        while 1:
+            pid, status = os.waitpid(-1, 0)
+            if pid in children: break
+        i = children[pid]
+        del children[pid]
+        if status:
+            logger.put(0, 'Shard %d exited abnormally (status %d), its '
+                       'lines are missing from the report' % (i, status))
+            return [i]
+        logger.put(3, 'Shard %d done' % i)
+        return []
+
+    def _run_shard(self, i, job, logmap):
+        """
+        Process one shard in a forked process and write out the results.
+        Never returns.
+        """
+        logger = self.logger
+        status = 1
+        try:
             try:
-                rs = pq.get_resultset(module)
-                try:
-                    module.finalize_processing(rs)
-                except Exception, e:
-                    msg = ('Module %s crashed in finalize stage: %s' % 
-                           (module.name, e))
-                    logger.put(0, msg)
-                    module.no_report()
-            except KeyError:
-                module.no_report()
-            logger.endhang(1)
-        logger.endhang(1)
-        logger.endhang(1)
-        logger.put(5, '<Epylog._process_internal_modules')
+                entry, orange = job
+                logger.put(3, 'Shard %d of "%s" starting' % (i, entry))
+                log = self.logtracker.getlog(entry)
+                log.reopen()
+                for module in logmap[entry]:
+                    modix = self.imodules.index(module)
+                    filtfile = self._shard_file(i, '%d.FILTER' % modix)
+                    module.filtfh = open(filtfile, 'w')
+                upfh = open(self._shard_file(i, 'UNPARSED'), 'w')
+                resultsets = self._process_logs(logmap, [job], upfh)
+                upfh.close()
+                for module in logmap[entry]: module.filtfh.close()
+                results = {}
+                for module, rs in resultsets.items():
+                    results[self.imodules.index(module)] = rs
+                fh = open(self._shard_file(i, 'RESULTS'), 'wb')
+                hits = {}
+                for module in logmap[entry]:
+                    hits[self.imodules.index(module)] = module.get_hits()
+                pickle.dump((results, log.last_messages, hits), fh, 1)
+                fh.close()
+                status = 0
+            except Exception, e:
+                logger.put(0, 'Shard %d crashed: %s' % (i, e))
+        finally:
+            sys.stdout.flush()
+            os._exit(status)
+
+    def _shard_file(self, i, suffix):
+        """
+        Where shard processes put their output.
+        """
+        return os.path.join(self.tmpprefix, 'SHARD%d.%s' % (i, suffix))
 
 class ProcessingQueue:
     """
-    This is a standard cookie-cutter helper class for using threads in a
-    Python application.
+    Hands the matched lines over from the main thread to the processing
+    threads. Lines are put into chunks of "batch" items without any
+    locking, and only whole chunks go through the lock, so the threads
+    do not fight over it for every line. When more than "high" lines
+    are waiting, the main thread stops until the threads get them down
+    to "low".
     """
-    def __init__(self, limit, logger):
+    def __init__(self, batch, high, low, logger):
         self.logger = logger
         logger.put(5, '>ProcessingQueue.__init__')
         logger.put(3, 'Initializing ProcessingQueue')
-        self.mon = threading.RLock()
+        self.mon = threading.Lock()
         self.iw = threading.Condition(self.mon)
         self.ow = threading.Condition(self.mon)
-        self.lineq = []
+        self.chunks = deque()
+        self.chunk = []
+        self.chunklines = 0
         self.resultsets = {}
-        self.limit = limit
+        self.batch = batch
+        self.high = high
+        self.low = low
         self.working = 1
+        self.retire = 0
+        ##
+        # depth:     how many lines are in the queued chunks
+        # max_depth: the most there ever were
+        # lines:     how many lines were queued
+        # put_wait:  how long the main thread waited for the threads
+        #
+        self.depth = 0
+        self.max_depth = 0
+        self.lines = 0
+        self.nchunks = 0
+        self.put_wait = 0.0
         logger.put(5, '<ProcessingQueue.__init__')
 
     def put_linemap(self, linemap, handler, module):
         """
-        Accepts a linemap and stores it to be picked up by a thread.
+        Accepts a linemap to be picked up by a thread, once its chunk is
+        full or flush() is called.
         """
+        self.chunk.append([linemap, handler, module, 0])
+        self.chunklines += 1
+        if len(self.chunk) >= self.batch: self.flush()
+
+    def put_batch(self, linemaps, handler, module):
+        """
+        Accepts a list of linemaps for a batch handler, to be picked up
+        by a thread as one item.
+        """
+        self.chunk.append([linemaps, handler, module, 1])
+        self.chunklines += len(linemaps)
+        self.flush()
+
+    def flush(self):
+        """
+        Queue the chunk being filled, waiting if too many lines are
+        queued already.
+        """
+        if not self.chunk: return
         self.mon.acquire()
         logger = self.logger
-        logger.put(5, '>ProcessingQueue.put_linemap')
-        while len(self.lineq) >= self.limit:
+        logger.put(5, '>ProcessingQueue.flush')
+        if self.depth >= self.high:
             logger.put(5, 'Line queue is full, waiting...')
-            self.ow.wait()
-        self.lineq.append([linemap, handler, module])
-        logger.put(3, 'Added a new line in lineq')
-        logger.put(5, 'items in lineq: %d' % len(self.lineq))
+            start = time.time()
+            while self.depth > self.low: self.ow.wait()
+            self.put_wait += time.time() - start
+        self.chunks.append((self.chunklines, self.chunk))
+        self.depth += self.chunklines
+        if self.depth > self.max_depth: self.max_depth = self.depth
+        self.lines += self.chunklines
+        self.nchunks += 1
+        logger.put(3, 'Added a chunk of %d items' % len(self.chunk))
+        logger.put(5, 'lines in queue: %d' % self.depth)
+        self.chunk = []
+        self.chunklines = 0
         self.iw.notify()
-        logger.put(5, '<ProcessingQueue.put_linemap')
+        logger.put(5, '<ProcessingQueue.flush')
         self.mon.release()
 
-    def get_linemap(self):
+    def get_chunk(self):
         """
-        This is used by a running thread, which gets the linemap
-        and processes it.
+        This is used by a running thread, which gets a chunk of items
+        and processes them. Returns None when there is no more work, or
+        when the thread is to retire.
         """
         self.mon.acquire()
         logger = self.logger
-        logger.put(5, '>ProcessingQueue.get_linemap')
-        while not self.lineq and self.working:
+        logger.put(5, '>ProcessingQueue.get_chunk')
+        if not self.chunks and self.working and not self.retire:
             logger.put(5, 'Line queue is empty, waiting...')
-            self.iw.wait()
-        if self.working:
-            item = self.lineq.pop(0)
-            logger.put(3, 'Got new linemap for the thread.')
-            logger.put(5, 'items in lineq: %d' % len(self.lineq))
-            self.ow.notify()
-        else: item = None
-        logger.put(5, '<ProcessingQueue.get_linemap')
+            while not self.chunks and self.working and not self.retire:
+                self.iw.wait()
+        if self.retire:
+            self.retire -= 1
+            logger.put(3, 'Retiring a thread')
+            chunk = None
+        elif self.chunks:
+            lines, chunk = self.chunks.popleft()
+            self.depth -= lines
+            logger.put(3, 'Got a new chunk for the thread.')
+            logger.put(5, 'lines in queue: %d' % self.depth)
+            if self.depth <= self.low: self.ow.notify()
+        else: chunk = None
+        logger.put(5, '<ProcessingQueue.get_chunk')
         self.mon.release()
-        return item
+        return chunk
 
-    def put_result(self, line, result, module):
+    def collect(self, threads):
         """
-        Once the running thread is done with the module, it returns the
-        result and places it here.
+        Once the threads are done, add up the results each of them kept
+        on its own, in the order the threads were started, and write out
+        what is left of their filtered lines.
         """
-        self.mon.acquire()
         logger = self.logger
-        logger.put(5, '>ProcessingQueue.put_result')
-        if result is not None:
-            try: self.resultsets[module].add_result(result)
-            except KeyError:
-                self.resultsets[module] = Result()
-                self.resultsets[module].add_result(result)
-            module.put_filtered(line)
-            logger.put(3, 'Added result from module "%s"' % module.name)
-        else:
-            logger.put(3, '"%s" returned result None. Skipping.' % module.name)
-        logger.put(5, '<ProcessingQueue.put_result')
-        self.mon.release()
+        logger.put(5, '>ProcessingQueue.collect')
+        for t in threads:
+            for module, rs in t.resultsets.items():
+                try: self.resultsets[module].add_resultset(rs)
+                except KeyError: self.resultsets[module] = rs
+            for module, lines in t.filtered.items():
+                if lines: module.put_filtered(lines)
+            t.resultsets = {}
+            t.filtered = {}
+        logger.put(5, '<ProcessingQueue.collect')
 
     def get_resultset(self, module):
         """
@@ -584,21 +1286,46 @@ class ProcessingQueue:
         """
         Tell all threads that they should exit as soon as possible.
         """
+        self.flush()
         self.mon.acquire()
         logger = self.logger
         logger.put(5, '>ProcessingQueue.tell_threads_to_quit')
         logger.put(1, 'Telling all threads to quit')
         logger.put(5, 'Waiting till queue is empty')
-        while self.lineq:
-            logger.put(5, 'items in lineq: %d' % len(self.lineq))
+        while self.chunks:
+            logger.put(5, 'lines in queue: %d' % self.depth)
             self.ow.wait()
         self.logger.put(5, 'working=0')
         self.working = 0
         logger.put(3, 'Sending %d semaphore notifications' % len(threads))
-        for t in threads: self.iw.notify()
+        self.iw.notifyAll()
         logger.put(5, '<ProcessingQueue.tell_threads_to_quit')
         self.mon.release()
 
+    def retire_threads(self, count):
+        """
+        Have "count" of the threads exit, once they are done with the
+        chunks they have.
+        """
+        self.mon.acquire()
+        self.logger.put(3, 'Retiring %d threads' % count)
+        self.retire += count
+        self.iw.notifyAll()
+        self.mon.release()
+
+    def put_stats(self, threads):
+        """
+        Log how the queue and the threads did, at debug level 1.
+        """
+        logger = self.logger
+        logger.put(1, 'Processing queue: %d lines in %d chunks, at most %d '
+                   'queued, main thread waited %.2fs for the threads'
+                   % (self.lines, self.nchunks, self.max_depth,
+                      self.put_wait))
+        for t in threads:
+            logger.put(1, '%s: %d lines in %d chunks, busy %.2fs, idle %.2fs'
+                       % (t.getName(), t.lines, t.chunks, t.busy, t.idle))
+
 class ConsumerThread(threading.Thread):
     """
     This class extends Thread, and is used to thread up the internal
@@ -609,39 +1336,364 @@ class ConsumerThread(threading.Thread):
         logger.put(5, '>ConsumerThread.__init__')
         self.logger = logger
         self.queue = queue
+        ##
+        # resultsets: the results of the handlers, for each module
+        # filtered:   the lines that gave them, for each module, until
+        #             there are FILTER_FLUSH of them to write out
+        #
+        self.resultsets = {}
+        self.filtered = {}
+        ##
+        # busy:   how long the thread spent on its chunks
+        # idle:   how long it waited for them
+        # chunks: how many chunks it got
+        # lines:  how many lines were in them
+        #
+        self.busy = 0.0
+        self.idle = 0.0
+        self.chunks = 0
+        self.lines = 0
         logger.put(5, '<ConsumerThread.__init__')
 
     def run(self):
         logger = self.logger
         logger.put(5, '>ConsumerThread.run')
-        while self.queue.working:
-            logger.put(3, '%s: getting a new linemap' % self.getName())
-            item = self.queue.get_linemap()
-            if item is not None:
-                linemap, handler, module = item
-                logger.put(3, '%s: calling the handler' % self.getName())
-                try:
-                    result = handler(linemap)
-                    if result is not None:
-                        line = linemap['line']
-                        logger.put(5, '%s: returning result' % self.getName())
-                        self.queue.put_result(line, result, module)
-                    else:
-                        logger.put(5, '%s: Result is None.' % self.getName())
-                except Exception, e:
-                    erep  = 'Handler crash. Dump follows:\n'
-                    erep += '  Thread : %s\n' % self.getName()
-                    erep += '  Module : %s\n' % module.executable
-                    erep += '  Handler: %s\n' % handler.__name__
-                    erep += '  Error  : %s\n' % e
-                    erep += '  Line   : %s\n' % linemap['line'].strip()
-                    erep += 'End Dump'
-                    logger.put(0, erep)
-            else:
-                logger.put(5, '%s: Item is none.' % self.getName())
+        while 1:
+            logger.put(3, '%s: getting a new chunk' % self.getName())
+            start = time.time()
+            chunk = self.queue.get_chunk()
+            self.idle += time.time() - start
+            if chunk is None: break
+            start = time.time()
+            self._run_chunk(chunk)
+            self.busy += time.time() - start
+            self.chunks += 1
+            for item in chunk:
+                if item[3]: self.lines += len(item[0])
+                else: self.lines += 1
+        self._done()
         logger.put(3, '%s: I am now dying' % self.getName())
         logger.put(5, '<ConsumerThread.run')
 
+    def _done(self):
+        """
+        Called when there are no more chunks for the thread.
+        """
+        pass
+
+    def _run_chunk(self, chunk):
+        """
+        Call the handlers for all items in a chunk from the queue.
+        """
+        for item in chunk:
+            if item[3]: self._run_batch(item[0], item[1], item[2])
+            else: self._run_handler(item[0], item[1], item[2])
+
+    def _report_crash(self, erep):
+        """
+        Log the dump made when a handler crashed.
+        """
+        self.logger.put(0, erep)
+
+    def _add_filtered(self, module, lines):
+        """
+        Keep the filtered lines for a module, writing them out once
+        there are enough of them.
+        """
+        try: filtered = self.filtered[module]
+        except KeyError: filtered = self.filtered[module] = []
+        filtered.extend(lines)
+        if len(filtered) >= FILTER_FLUSH:
+            module.put_filtered(filtered)
+            self.filtered[module] = []
+
+    def _run_handler(self, linemap, handler, module):
+        """
+        Call a handler with a linemap.
+        """
+        logger = self.logger
+        logger.put(3, '%s: calling the handler' % self.getName())
+        try:
+            result = handler(linemap)
+            if result is not None:
+                logger.put(5, '%s: keeping result' % self.getName())
+                try: self.resultsets[module].add_result(result)
+                except KeyError:
+                    self.resultsets[module] = Result()
+                    self.resultsets[module].add_result(result)
+                self._add_filtered(module, [linemap['line']])
+            else:
+                logger.put(5, '%s: Result is None.' % self.getName())
+        except Exception, e:
+            erep  = 'Handler crash. Dump follows:\n'
+            erep += '  Thread : %s\n' % self.getName()
+            erep += '  Module : %s\n' % module.executable
+            erep += '  Handler: %s\n' % handler.__name__
+            erep += '  Error  : %s\n' % e
+            erep += '  Line   : %s\n' % linemap['line'].strip()
+            erep += 'End Dump'
+            self._report_crash(erep)
+
+    def _run_batch(self, linemaps, handler, module):
+        """
+        Call a batch handler with a list of linemaps. All of the lines
+        are taken as handled.
+        """
+        logger = self.logger
+        logger.put(3, '%s: calling the batch handler for %d lines'
+                   % (self.getName(), len(linemaps)))
+        try:
+            results = handler(linemaps)
+            try: self.resultsets[module].add_resultset(results)
+            except KeyError:
+                self.resultsets[module] = Result()
+                self.resultsets[module].add_resultset(results)
+            lines = []
+            for linemap in linemaps: lines.append(linemap['line'])
+            self._add_filtered(module, lines)
+        except Exception, e:
+            erep  = 'Handler crash. Dump follows:\n'
+            erep += '  Thread : %s\n' % self.getName()
+            erep += '  Module : %s\n' % module.executable
+            erep += '  Handler: %s\n' % handler.__name__
+            erep += '  Error  : %s\n' % e
+            erep += '  Lines  : %d, first one:\n' % len(linemaps)
+            erep += '  %s\n' % linemaps[0]['line'].strip()
+            erep += 'End Dump'
+            self._report_crash(erep)
+
+class ConsumerProcess(ConsumerThread):
+    """
+    A processing thread that hands its chunks over to a forked worker
+    process with its own copy of the loaded internal modules, so the
+    handlers are not all stuck behind one interpreter lock. Chunks go
+    to the worker through a pipe, with the handlers and regexes given
+    by number and the linemaps without their matches, which the worker
+    makes again. The worker sends back the filtered lines and the crash
+    dumps for every chunk, and its results once there is no more work.
+    Should the worker die, the thread handles the rest of the chunks
+    itself, and the lines the worker had are missing from the report.
+    """
+    def __init__(self, queue, imodules, siblings, logger):
+        ConsumerThread.__init__(self, queue, logger)
+        logger.put(5, '>ConsumerProcess.__init__')
+        self.imodules = imodules
+        ##
+        # handlers: (module index, handler) for all handlers and batch
+        #           handlers of the modules
+        # regexes:  all regexes of the modules
+        # The worker is forked with the same lists, so the numbers mean
+        # the same on both ends, however the modules reorder them.
+        #
+        self.module_index = {}
+        self.handlers = []
+        self.handler_index = {}
+        self.regexes = []
+        self.regex_index = {}
+        for modix in range(len(imodules)):
+            module = imodules[modix]
+            self.module_index[module] = modix
+            handlers = module.batch_map.values()
+            for entry in module.match_list:
+                self.regex_index[entry[0]] = len(self.regexes)
+                self.regexes.append(entry[0])
+                handlers.append(entry[1])
+            for handler in handlers:
+                if (modix, handler) in self.handler_index: continue
+                self.handler_index[(modix, handler)] = len(self.handlers)
+                self.handlers.append((modix, handler))
+        ##
+        # worker: set in the worker process
+        # sent:   the filtered lines of the chunk, for the worker to send
+        # dumps:  the crash dumps of the chunk, likewise
+        #
+        self.worker = 0
+        self.sent = []
+        self.dumps = []
+        ##
+        # Anything still in the buffer would be written out by the
+        # worker as well.
+        #
+        sys.stdout.flush()
+        fromworker, toparent = os.pipe()
+        fromparent, toworker = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            ##
+            # Whatever happens, the worker must not go back into the code
+            # of the parent. Of the pipes to the other workers only the
+            # descriptors are closed, as closing the files would flush
+            # what the parent left in their buffers into those pipes.
+            #
+            try:
+                os.close(fromworker)
+                os.close(toworker)
+                for sibling in siblings:
+                    if not isinstance(sibling, ConsumerProcess): continue
+                    for fh in (sibling.toworker, sibling.fromworker):
+                        try: os.close(fh.fileno())
+                        except (OSError, ValueError): pass
+                self._serve(os.fdopen(fromparent, 'rb'),
+                            os.fdopen(toparent, 'wb'))
+            finally:
+                os._exit(1)
+        os.close(fromparent)
+        os.close(toparent)
+        self.fromworker = os.fdopen(fromworker, 'rb')
+        self.toworker = os.fdopen(toworker, 'wb')
+        logger.put(3, 'Started worker process %d' % self.pid)
+        logger.put(5, '<ConsumerProcess.__init__')
+
+    def _run_chunk(self, chunk):
+        """
+        Have the worker process the chunk, or do it here if it is gone.
+        """
+        if self.pid is not None:
+            try:
+                self._send_chunk(chunk)
+                return
+            except Exception, e:
+                self._lose_worker(e)
+        ConsumerThread._run_chunk(self, chunk)
+
+    def _done(self):
+        """
+        Get the results from the worker.
+        """
+        if self.pid is not None:
+            try: self._get_results()
+            except Exception, e: self._lose_worker(e)
+
+    def _send_chunk(self, chunk):
+        """
+        Have the worker process a chunk, and take care of the filtered
+        lines and crash dumps it sends back.
+        """
+        logger = self.logger
+        logger.put(3, '%s: sending the chunk to worker %d'
+                   % (self.getName(), self.pid))
+        items = []
+        for data, handler, module, batch in chunk:
+            modix = self.module_index[module]
+            handix = self.handler_index[(modix, handler)]
+            if batch:
+                packed = []
+                for linemap in data:
+                    packed.append((linemap, self.regex_index[linemap.regex]))
+            else: packed = (data, self.regex_index[data.regex])
+            items.append((handix, batch, packed))
+        pickle.dump(items, self.toworker, pickle.HIGHEST_PROTOCOL)
+        self.toworker.flush()
+        sent, dumps = pickle.load(self.fromworker)
+        for erep in dumps: self.logger.put(0, erep)
+        for modix, lines in sent:
+            self._add_filtered(self.imodules[modix], lines)
+
+    def _get_results(self):
+        """
+        Tell the worker there is no more work, and take its results.
+        """
+        logger = self.logger
+        logger.put(3, '%s: getting the results from worker %d'
+                   % (self.getName(), self.pid))
+        pickle.dump(None, self.toworker, pickle.HIGHEST_PROTOCOL)
+        self.toworker.flush()
+        results = pickle.load(self.fromworker)
+        for modix, rs in results.items():
+            self.resultsets[self.imodules[modix]] = rs
+        self._close_pipes()
+        pid, status = os.waitpid(self.pid, 0)
+        self.pid = None
+        if status:
+            logger.put(0, 'Worker process %d exited abnormally (status %d)'
+                       % (pid, status))
+
+    def _lose_worker(self, e):
+        """
+        Give up on a worker that failed, and wait for it to exit.
+        """
+        logger = self.logger
+        reason = str(e) or e.__class__.__name__
+        logger.put(0, '%s: worker process %d failed (%s), its lines are '
+                   'missing from the report' % (self.getName(), self.pid,
+                                                reason))
+        self._close_pipes()
+        try: os.waitpid(self.pid, 0)
+        except OSError: pass
+        self.pid = None
+
+    def _close_pipes(self):
+        """
+        Close this end of the pipes to the worker, if still open.
+        """
+        for fh in (self.toworker, self.fromworker):
+            try: fh.close()
+            except IOError: pass
+
+    def _serve(self, rfh, wfh):
+        """
+        What the worker process does with the chunks it gets from the
+        thread. Never returns.
+        """
+        logger = self.logger
+        self.worker = 1
+        status = 1
+        try:
+            try:
+                while 1:
+                    items = pickle.load(rfh)
+                    if items is None: break
+                    for handix, batch, packed in items:
+                        modix, handler = self.handlers[handix]
+                        module = self.imodules[modix]
+                        if batch:
+                            linemaps = []
+                            for linemap, regexix in packed:
+                                linemap.rematch(self.regexes[regexix])
+                                linemaps.append(linemap)
+                            self._run_batch(linemaps, handler, module)
+                        else:
+                            linemap, regexix = packed
+                            linemap.rematch(self.regexes[regexix])
+                            self._run_handler(linemap, handler, module)
+                    pickle.dump((self.sent, self.dumps), wfh,
+                                pickle.HIGHEST_PROTOCOL)
+                    wfh.flush()
+                    self.sent = []
+                    self.dumps = []
+                results = {}
+                for module, rs in self.resultsets.items():
+                    results[self.module_index[module]] = rs
+                pickle.dump(results, wfh, pickle.HIGHEST_PROTOCOL)
+                wfh.flush()
+                status = 0
+            except Exception, e:
+                logger.put(0, 'Worker process of %s crashed: %s'
+                           % (self.getName(), e))
+        finally:
+            sys.stdout.flush()
+            os._exit(status)
+
+    def _add_filtered(self, module, lines):
+        """
+        In the worker, keep the filtered lines to send them back with
+        the chunk.
+        """
+        if not self.worker:
+            ConsumerThread._add_filtered(self, module, lines)
+            return
+        self.sent.append((self.module_index[module], lines))
+
+    def _report_crash(self, erep):
+        """
+        In the worker, keep the crash dump to send it back with the
+        chunk, so it is logged where the thread would log it.
+        """
+        if not self.worker:
+            ConsumerThread._report_crash(self, erep)
+            return
+        self.dumps.append(erep)
+
 class Result(dict):
     """
     Result is an extension of a standard dictionary.
@@ -656,6 +1708,14 @@ class Result(dict):
             else: self[restuple] = mult
         except KeyError: pass
 
+    def add_resultset(self, rs):
+        """
+        Adds all results from another resultset to this one.
+        """
+        for restuple, mult in rs.items():
+            if restuple in self: self[restuple] += mult
+            else: self[restuple] = mult
+
     def get_distinct(self, matchtup, sort=1):
         """
         This is a helper method that allows one to do the following:
@@ -734,17 +1794,236 @@ class Result(dict):
         if self: return 0
         else: return 1
 
+class HostResolver:
+    """
+    Resolves the host tokens that InternalModule.gethost leaves in the
+    results, for all modules at once, before they make their reports.
+    Each distinct address is looked up once, by up to "threads" threads
+    at a time. A lookup that takes longer than "timeout" seconds is
+    given up on, and so are the ones still left when "budget" seconds
+    are up. Those addresses are shown as they are.
+    """
+    def __init__(self, threads, timeout, budget, logger):
+        self.threads = threads
+        self.timeout = timeout
+        self.budget = budget
+        self.logger = logger
+
+    def resolve(self, resultsets):
+        """
+        Replace the host tokens in the resultsets, a dict of resultsets
+        for each module, with the names. Results that end up the same
+        are added up.
+        """
+        logger = self.logger
+        logger.put(5, '>HostResolver.resolve')
+        addrs = {}
+        for rs in resultsets.values():
+            for restuple in rs.keys(): self._find_tokens(restuple, addrs)
+        if addrs:
+            names = self._lookup_all(addrs.keys())
+            for key, rs in resultsets.items():
+                resolved = Result()
+                for restuple, mult in rs.items():
+                    restuple = self._replace_tokens(restuple, names)
+                    try: resolved[restuple] += mult
+                    except KeyError: resolved[restuple] = mult
+                resultsets[key] = resolved
+        logger.put(5, '<HostResolver.resolve')
+
+    def _find_tokens(self, item, addrs):
+        """
+        Add the addresses in the host tokens found in item to addrs.
+        """
+        if isinstance(item, str):
+            if '\x00' in item:
+                for addr in HOST_TOKEN_RE.findall(item): addrs[addr] = 1
+        elif isinstance(item, tuple):
+            for member in item: self._find_tokens(member, addrs)
+
+    def _replace_tokens(self, item, names):
+        """
+        Return item with the host tokens in it replaced with the names,
+        or the addresses, if there is no name for them.
+        """
+        if isinstance(item, str):
+            if '\x00' not in item: return item
+            def name(mo): return names.get(mo.group(1)) or mo.group(1)
+            return HOST_TOKEN_RE.sub(name, item)
+        if isinstance(item, tuple):
+            replaced = []
+            for member in item:
+                replaced.append(self._replace_tokens(member, names))
+            return tuple(replaced)
+        return item
+
+    def _lookup_all(self, addrs):
+        """
+        Look up the addresses, and return a dict with the names found.
+        """
+        logger = self.logger
+        logger.put(5, '>HostResolver._lookup_all')
+        start = time.time()
+        deadline = start + self.budget
+        names = {}
+        cond = threading.Condition()
+        pending = addrs[:]
+        running = {}
+        timedout = 0
+        while pending or running:
+            now = time.time()
+            for addr, started in running.items():
+                if addr in names: del running[addr]
+                elif now - started >= self.timeout:
+                    logger.put(3, 'Lookup of %s timed out' % addr)
+                    del running[addr]
+                    timedout += 1
+            if now >= deadline: break
+            while pending and len(running) < self.threads:
+                addr = pending.pop()
+                ##
+                # Threads stuck in a lookup are left behind, and must
+                # not keep epylog from exiting.
+                #
+                t = threading.Thread(target=self._lookup,
+                                     args=(addr, names, cond))
+                t.setDaemon(1)
+                t.start()
+                running[addr] = time.time()
+            if not running: continue
+            wait = deadline - now
+            for started in running.values():
+                wait = min(wait, started + self.timeout - now)
+            cond.acquire()
+            done = 0
+            for addr in running.keys():
+                if addr in names:
+                    done = 1
+                    break
+            if not done: cond.wait(max(wait, 0.01))
+            cond.release()
+        cond.acquire()
+        found = {}
+        for addr, name in names.items():
+            if name is not None: found[addr] = name
+        cond.release()
+        logger.put(1, 'Resolved %d of %d hosts in %.2fs, %d lookups timed '
+                   'out, %d left when time was up'
+                   % (len(found), len(addrs), time.time() - start, timedout,
+                      len(pending) + len(running)))
+        logger.put(5, '<HostResolver._lookup_all')
+        return found
+
+    def _lookup(self, addr, names, cond):
+        """
+        Look up one address, in a thread of its own.
+        """
+        try: name = socket.gethostbyaddr(addr)[0]
+        except (socket.error, UnicodeError, ValueError): name = None
+        cond.acquire()
+        names[addr] = name
+        cond.notify()
+        cond.release()
+
 class InternalModule:
     """
     This is a helper class to be extended by internal modules.
     """
+    ##
+    # Set to the vardir before the modules are made, for load_ruleset.
+    # It stays None when a module is tested on its own.
+    #
+    vardir = None
+
     def __init__(self):
         self._known_hosts = {}
         self._known_uids = {}
+        ##
+        # tag_map: regexes from regex_map that only apply to lines from
+        #          certain programs, mapped to the program tag, or a
+        #          tuple of them. Those are not tried on other lines,
+        #          so only map regexes that could not match them anyway.
+        # regex_order_safe: set if it does not matter which regex
+        #          matches a line first, so the ones matching most often
+        #          can be tried first.
+        # batch_map: regexes from regex_map whose lines are handed over
+        #          in batches, mapped to the batch handler, usually
+        #          handle_batch.
+        # defer_hosts: unset if the handlers need the names from
+        #          gethost right away, not just to put them in results.
+        # ruleset_version: kept with the rulesets from load_ruleset, to
+        #          be raised whenever the module parses its rules
+        #          differently, so the old ones are not used.
+        #
+        self.tag_map = {}
+        self.regex_order_safe = 0
+        self.batch_map = {}
+        self.defer_hosts = 1
+        self.ruleset_version = 0
         self.amp_re = re.compile('&')
         self.lt_re  = re.compile('<')
         self.gt_re  = re.compile('>')
 
+    def load_ruleset(self, name, sources, parse, *args):
+        """
+        Return what parse(*args) returns, e.g. the rules read from some
+        files and checked. The result is kept in the vardir under the
+        given name, along with the mtime, size and md5 of each of the
+        source files, and reused as long as none of them changed and the
+        args and the module's ruleset_version are the same. It must
+        therefore be picklable. Nothing is kept if parse returns None.
+        """
+        logger = self.logger
+        logger.put(5, '>InternalModule.load_ruleset')
+        filename = RULESET_FILE % name
+        fingerprint = []
+        for source in sources:
+            try:
+                stat = os.stat(source)
+                fh = open(source)
+                digest = md5_new(fh.read()).hexdigest()
+                fh.close()
+                fingerprint.append((source, stat.st_mtime, stat.st_size,
+                                    digest))
+            except (IOError, OSError):
+                fingerprint.append((source, None, None, None))
+        state = load_state(self.vardir, filename, logger)
+        version = self.ruleset_version
+        try:
+            stored, stored_args, stored_version, ruleset = state
+            if (stored == fingerprint and stored_args == args
+                and stored_version == version):
+                logger.put(3, 'Using the cached ruleset "%s"' % name)
+                logger.put(5, '<InternalModule.load_ruleset')
+                return ruleset
+        except (TypeError, ValueError):
+            pass
+        ruleset = parse(*args)
+        if ruleset is not None:
+            save_state(self.vardir, filename,
+                       (fingerprint, args, version, ruleset), logger)
+        logger.put(5, '<InternalModule.load_ruleset')
+        return ruleset
+
+    def handle_batch(self, linemaps):
+        """
+        Handle a batch of lines matched by the regexes in batch_map, and
+        return the results for all of them added up, as a dict like the
+        ones returned by the handlers. All lines in the batch are taken
+        as handled, so only regexes whose handlers always return results
+        should be in batch_map. This one just calls the handlers from
+        regex_map; modules may do better by counting on their own.
+        """
+        results = {}
+        for linemap in linemaps:
+            handler = self.regex_map[linemap.regex]
+            if isinstance(handler, tuple): handler = handler[0]
+            result = handler(linemap)
+            if result is None: continue
+            for restuple, mult in result.items():
+                results[restuple] = results.get(restuple, 0) + mult
+        return results
+
     def htmlsafe(self, unsafe):
         """
         Escapes all x(ht)ml control characters.
@@ -767,13 +2046,19 @@ class InternalModule:
         return name
 
     def gethost(self, ip_addr):
-        """do reverse lookup on an ip address"""
+        """
+        do reverse lookup on an ip address. Unless defer_hosts is unset,
+        this returns a token for the address instead, which is replaced
+        with the name in the results before finalize. It can go into
+        the results as it is, or as part of a string.
+        """
         ##
         # Handle silly fake ipv6 addresses
         #
         try:
             if ip_addr[:7] == '::ffff:': ip_addr = ip_addr[7:]
         except: pass
+        if self.defer_hosts: return HOST_TOKEN % ip_addr
         try: return self._known_hosts[ip_addr]
         except KeyError: pass
         try: name = socket.gethostbyaddr(ip_addr)[0]
@@ -786,7 +2071,7 @@ class InternalModule:
         Return a systemname, message, and multiplier from a linemap, since
         these are most commonly needed in a module.
         """
-        return (lm['system'], lm['message'], lm['multiplier'])
+        return (lm.system, lm.message, lm.multiplier)
 
     def mk_size_unit(self, size):
         """
@@ -87,10 +87,15 @@ class ModuleTest:
             line = line.strip()
             linemap = self._mk_linemap(line, monthmap)
             msg = linemap['message']
-            for regex in epymod.regex_map.keys():
-                if regex.search(msg):
+            regexes = getattr(epymod, 'regex_order', None)
+            if not regexes: regexes = epymod.regex_map.keys()
+            for regex in regexes:
+                mo = regex.search(msg)
+                if mo:
                     handler = epymod.regex_map[regex]
-                    linemap['regex'] = regex
+                    fieldspec = None
+                    if isinstance(handler, tuple): handler, fieldspec = handler
+                    linemap.set_match(mo, fieldspec)
                     logger.put(5, '%s -> %s' % (handler.__name__, msg))
                     result = handler(linemap)
                     if result is not None:
@@ -101,6 +106,13 @@ class ModuleTest:
         infh.close()
         if filtfile is not None: filtfh.close()
         if not rs.is_empty():
+            logger.put(5, 'Resolving the hosts')
+            resolver = epylog.HostResolver(epylog.RESOLVE_THREADS,
+                                           epylog.RESOLVE_TIMEOUT,
+                                           epylog.RESOLVE_BUDGET, logger)
+            resultsets = {epymod: rs}
+            resolver.resolve(resultsets)
+            rs = resultsets[epymod]
             logger.put(5, 'Finalizing')
             report = epymod.finalize(rs)
             if repfile is not None:
@@ -121,15 +133,12 @@ class ModuleTest:
         Create a linemap out of a line entry.
         """
         try:
-            stamp, sys, msg = epylog.log.get_stamp_sys_msg(line, monthmap)
+            datestr, sys, msg = epylog.log.split_syslog_line(line)
         except ValueError:
             msg = 'Invalid syslog line: %s' % line
             self._die(msg)
-        linemap = {'line': line,
-                   'stamp': stamp,
-                   'system': sys,
-                   'message': msg,
-                   'multiplier': 1}
+        linemap = epylog.log.LineRecord(line, sys, msg, datestr=datestr,
+                                        monthmap=monthmap)
         return linemap
 
     def _die(self, message):
@@ -31,6 +31,9 @@ import os
 import re
 import string
 import time
+import zlib
+import bisect
+import threading
 import tempfile
 
 if 'mkdtemp' not in dir(tempfile):
@@ -40,6 +43,27 @@ if 'mkdtemp' not in dir(tempfile):
     del tempfile
     import mytempfile as tempfile
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import mmap
+except ImportError:
+    ##
+    # No mmap on this platform. LogFile will use the buffered reader.
+    #
+    mmap = None
+
+try:
+    import pyinotify
+except ImportError:
+    ##
+    # No inotify. LogWatcher will just poll.
+    #
+    pyinotify = None
+
 def mkmonthmap():
     """
     The problem with syslog is that it does not log the year when the
@@ -65,40 +89,649 @@ def mkmonthmap():
         monthmap[monthname] = year
     return monthmap
 
-def mkstamp_from_syslog_datestr(datestr, monthmap):
+##
+# Epoch of the first second of each "year Mon DD HH:MM" minute seen so far.
+# Syslog lines come in time order, so most of them fall into a minute
+# we already know, and we only need to add the seconds.
+#
+_minute_stamps = {}
+MINUTE_CACHE_LIMIT = 100000
+
+def _mkstamp_from_minute(y, m, d, hm):
     """
-    Takes a syslog date string and makes a timestamp out of it.
+    Takes the year, month name, day and "HH:MM" and returns the epoch of
+    the start of that minute, or -1 if it does not make sense.
     """
+    key = (y, m, d, hm)
+    try: return _minute_stamps[key]
+    except KeyError: pass
     try:
-        (m, d, t) = datestr.split()[:3]
-        y = str(monthmap[m])
-        datestr = string.join([y, m, d, t], ' ')
+        datestr = '%d %s %s %s:00' % key
         tuptime = time.strptime(datestr, '%Y %b %d %H:%M:%S')
         ##
         # Python 2.2.2 (at least) breaks with DST.
-        # Work around.
+        # Work around. DST only ever changes on a minute boundary, so the
+        # result is good for every second in this minute.
         #
         localtime = time.localtime(time.mktime(tuptime))
         ltime = list(tuptime)
         ltime[8] = localtime[8]
         tuptime = tuple(ltime)
         timestamp = int(time.mktime(tuptime))
-    except:
+    except (ValueError, OverflowError):
         timestamp = -1
+    if len(_minute_stamps) >= MINUTE_CACHE_LIMIT: _minute_stamps.clear()
+    _minute_stamps[key] = timestamp
     return timestamp
 
+def mkstamp_from_syslog_datestr(datestr, monthmap):
+    """
+    Takes a syslog date string and makes a timestamp out of it.
+    """
+    try:
+        (m, d, t) = datestr.split()[:3]
+        y = monthmap[m]
+        ix = t.rindex(':')
+        hm, sec = t[:ix], t[ix+1:]
+    except (ValueError, KeyError):
+        return -1
+    ##
+    # strptime would not take these either, and the minute cache does
+    # not check the seconds.
+    #
+    if not sec.isdigit() or len(sec) > 2 or int(sec) > 61: return -1
+    if len(hm) != 5 or hm[2] != ':': return -1
+    if not hm[:2].isdigit() or not hm[3:].isdigit(): return -1
+    timestamp = _mkstamp_from_minute(y, m, d, hm)
+    if timestamp == -1: return -1
+    return timestamp + int(sec)
+
+def mkstamps_from_syslog_datestrs(datestrs, monthmap):
+    """
+    Same as mkstamp_from_syslog_datestr, but takes a list of the 15-char
+    "Mon DD HH:MM:SS" date strings and returns a list of timestamps. As
+    long as the strings stay in the same minute, only the seconds are
+    looked at.
+    """
+    stamps = []
+    append = stamps.append
+    lastminute = None
+    minutestamp = -1
+    for datestr in datestrs:
+        if datestr[:12] == lastminute and len(datestr) == 15:
+            sec = datestr[13:]
+            if sec.isdigit() and int(sec) <= 61:
+                append(minutestamp + int(sec))
+                continue
+        timestamp = mkstamp_from_syslog_datestr(datestr, monthmap)
+        append(timestamp)
+        if timestamp != -1 and len(datestr) == 15 and datestr[12] == ':':
+            lastminute = datestr[:12]
+            minutestamp = timestamp - int(datestr[13:])
+        else:
+            lastminute = None
+    return stamps
+
+def find_line_start(fh, offset, mm=None):
+    """
+    Return the offset of the start of the line the offset is in, and the
+    offset where that part of the line ends. Past the end of file this is
+    the start of the last line. The file is read backwards in blocks of
+    CHUNK_SIZE, or searched directly if it is memory-mapped. Where fh is
+    left afterwards is undefined.
+    """
+    if mm is not None:
+        end = offset + 1
+        if end > len(mm): end = len(mm) - 1
+        if end <= 0: return 0, 0
+        return mm.rfind('\n', 0, end) + 1, end
+    end = offset + 1
+    blockend = end
+    while blockend > 0:
+        blockstart = max(0, blockend - epylog.CHUNK_SIZE)
+        fh.seek(blockstart)
+        block = fh.read(blockend - blockstart)
+        if blockend == end and len(block) < blockend - blockstart:
+            ##
+            # Ran into the end of file. Go back from the last character,
+            # like we were sitting at the end of file.
+            #
+            if not block:
+                fh.seek(0, 2)
+                end = blockend = fh.tell()
+                if end == 0: return 0, 0
+                continue
+            block = block[:-1]
+            end = blockend = blockstart + len(block)
+        ix = block.rfind('\n')
+        if ix != -1: return blockstart + ix + 1, end
+        blockend = blockstart
+    return 0, max(end, 0)
+
+def split_syslog_line(line):
+    """
+    Split a syslog line into the date string, the system where the event
+    occured, and the message, without making a timestamp out of the date.
+    """
+    mo = epylog.LOG_SPLIT_RE.match(line)
+    if not mo: raise ValueError('Unknown line format: %s' % line)
+    datestr, sys, msg = mo.groups()
+    sys = epylog.SYSLOG_NG_STRIP.sub('', sys)
+    return datestr, sys, msg
+
+def split_syslog_lines(lines):
+    """
+    Same as split_syslog_line, but for a list of lines. Returns a list
+    with a (datestr, system, message) tuple for each line, or None for
+    the lines that are not in syslog format.
+    """
+    match = epylog.LOG_SPLIT_RE.match
+    strip = epylog.SYSLOG_NG_STRIP.sub
+    parsed = []
+    for line in lines:
+        mo = match(line)
+        if mo:
+            datestr, sys, msg = mo.groups()
+            parsed.append((datestr, strip('', sys), msg))
+        else:
+            parsed.append(None)
+    return parsed
+
 def get_stamp_sys_msg(line, monthmap):
     """
     This function takes a syslog line and returns the timestamp of the event,
     the system where it occured, and the message.
     """
-    mo = epylog.LOG_SPLIT_RE.match(line)
-    if not mo: raise ValueError('Unknown line format: %s' % line)
-    time, sys, msg = mo.groups()
-    stamp = mkstamp_from_syslog_datestr(time, monthmap)
-    sys = re.sub(epylog.SYSLOG_NG_STRIP, '', sys)
+    datestr, sys, msg = split_syslog_line(line)
+    stamp = mkstamp_from_syslog_datestr(datestr, monthmap)
     return stamp, sys, msg
 
+def get_stamps_sys_msgs(lines, monthmap):
+    """
+    Same as get_stamp_sys_msg, but for a list of lines. Returns a list
+    with a (stamp, system, message) tuple for each line, or None for
+    the lines that are not in syslog format.
+    """
+    parsed = split_syslog_lines(lines)
+    datestrs = [entry[0] for entry in parsed if entry is not None]
+    stamps = mkstamps_from_syslog_datestrs(datestrs, monthmap)
+    stamps.reverse()
+    for i in range(len(parsed)):
+        if parsed[i] is not None:
+            datestr, sys, msg = parsed[i]
+            parsed[i] = (stamps.pop(), sys, msg)
+    return parsed
+
+class LineRecord(object):
+    """
+    What the handlers get for each line: the line, the reporting system,
+    the message, the multiplier, the regex that matched, its match object,
+    the fields extracted from the match and the stamp. The stamp and the
+    fields are only worked out when somebody asks for them. For
+    compatibility with the old linemap dicts, the members can also be
+    read and set as linemap['message'] and so on.
+    """
+    __slots__ = ('line', 'system', 'message', 'multiplier', 'regex',
+                 'match', '_stamp', '_datestr', '_monthmap', '_fieldspec',
+                 '_fields')
+    keys = ('line', 'stamp', 'system', 'message', 'multiplier', 'regex',
+            'match', 'fields')
+    
+    def __init__(self, line, system, message, multiplier=1, stamp=None,
+                 datestr=None, monthmap=None):
+        self.line = line
+        self.system = system
+        self.message = message
+        self.multiplier = multiplier
+        self.regex = None
+        self.match = None
+        self._stamp = stamp
+        self._datestr = datestr
+        self._monthmap = monthmap
+        self._fieldspec = None
+        self._fields = None
+
+    def _get_stamp(self):
+        if self._stamp is None:
+            self._stamp = mkstamp_from_syslog_datestr(self._datestr,
+                                                      self._monthmap)
+        return self._stamp
+
+    def _set_stamp(self, stamp):
+        self._stamp = stamp
+
+    stamp = property(_get_stamp, _set_stamp)
+
+    def _get_fields(self):
+        if self._fields is None:
+            fields = {}
+            if self.match is None: pass
+            elif self._fieldspec is None: fields = self.match.groupdict()
+            else:
+                for name, group in self._fieldspec.items():
+                    fields[name] = self.match.group(group)
+            self._fields = fields
+        return self._fields
+
+    fields = property(_get_fields)
+
+    def set_match(self, match, fieldspec=None):
+        """
+        Record the match object of the regex that matched the message.
+        The fields are the named groups of the match, or, if a fieldspec
+        is given, a dict of field names mapped to group names or numbers.
+        """
+        self.regex = match.re
+        self.match = match
+        self._fieldspec = fieldspec
+        self._fields = None
+
+    def rematch(self, regex):
+        """
+        Match the message with the regex again, keeping the fieldspec,
+        after the record was unpickled.
+        """
+        self.set_match(regex.search(self.message), self._fieldspec)
+
+    def __getstate__(self):
+        """
+        Records are pickled without the regex and the match, which are
+        set again with rematch().
+        """
+        return (self.line, self.system, self.message, self.multiplier,
+                self._stamp, self._datestr, self._monthmap, self._fieldspec)
+
+    def __setstate__(self, state):
+        (self.line, self.system, self.message, self.multiplier, self._stamp,
+         self._datestr, self._monthmap, self._fieldspec) = state
+        self.regex = None
+        self.match = None
+        self._fields = None
+
+    def copy(self):
+        """
+        Return a copy of the record without the match.
+        """
+        linemap = LineRecord(self.line, self.system, self.message,
+                             self.multiplier, self._stamp, self._datestr,
+                             self._monthmap)
+        return linemap
+
+    def __getitem__(self, key):
+        if key not in LineRecord.keys: raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in LineRecord.keys: raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in LineRecord.keys
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        if key not in LineRecord.keys: return default
+        return getattr(self, key)
+
+    def __repr__(self):
+        return '<LineRecord %s: %r>' % (self.system, self.message)
+
+def _open_gzip(filename, logger):
+    return GzipLogReader(filename, logger)
+
+def _open_bz2(filename, logger):
+    import bz2
+    return bz2.BZ2File(filename)
+
+def _open_lzma(filename, logger):
+    try:
+        import lzma
+    except ImportError:
+        from backports import lzma
+    return lzma.LZMAFile(filename)
+
+class ZstdLogReader:
+    """
+    Reads a zstd-compressed file through a zstandard stream reader, and
+    closes the file along with the reader, which does not own it.
+    """
+    def __init__(self, filename, zstandard):
+        self.fh = open(filename, 'rb')
+        try:
+            dctx = zstandard.ZstdDecompressor()
+            self.reader = dctx.stream_reader(self.fh)
+        except:
+            self.fh.close()
+            raise
+
+    def read(self, size):
+        return self.reader.read(size)
+
+    def close(self):
+        try: self.reader.close()
+        finally: self.fh.close()
+
+def _open_zstd(filename, logger):
+    try:
+        import zstandard
+    except ImportError:
+        ##
+        # python-zstd can only do it in one go
+        #
+        import zstd
+        import StringIO
+        fh = open(filename, 'rb')
+        try: data = fh.read()
+        finally: fh.close()
+        return StringIO.StringIO(zstd.decompress(data))
+    return ZstdLogReader(filename, zstandard)
+
+##
+# Decompressors for rotated logs, tried in order against the filename.
+# Each entry is (suffix regex, name, opener, seekable). The opener takes
+# a filename and a logger and returns a file-like object with the
+# decompressed data. Seekable ones are used as they are, the rest are
+# inflated into a tempfile first.
+#
+DECOMPRESSORS = []
+
+def register_decompressor(suffix, name, opener, seekable=0):
+    """
+    Teach LogFile how to open rotated logs ending in suffix.
+    """
+    suffix_re = re.compile('%s$' % re.escape(suffix))
+    DECOMPRESSORS.append((suffix_re, name, opener, seekable))
+
+register_decompressor('.gz', 'gzip', _open_gzip, 1)
+register_decompressor('.bz2', 'bzip2', _open_bz2)
+register_decompressor('.xz', 'xz', _open_lzma)
+register_decompressor('.lzma', 'lzma', _open_lzma)
+register_decompressor('.zst', 'zstd', _open_zstd)
+register_decompressor('.zstd', 'zstd', _open_zstd)
+
+def get_decompressor(filename):
+    """
+    Return the (name, opener, seekable) decompressor for this filename,
+    or None if it does not look compressed.
+    """
+    for suffix_re, name, opener, seekable in DECOMPRESSORS:
+        if suffix_re.search(filename):
+            return (name, opener, seekable)
+    return None
+
+def open_compressed(filename, tmpprefix, logger):
+    """
+    Open a compressed logfile and return a file-like object with the
+    decompressed contents, inflating it into a tempfile in tmpprefix
+    unless the decompressor can seek by itself.
+    """
+    logger.put(5, '>log.open_compressed')
+    name, opener, seekable = get_decompressor(filename)
+    logger.put(3, 'Opening "%s" with the %s decompressor' % (filename, name))
+    try:
+        fh = opener(filename, logger)
+    except ImportError, e:
+        msg = ('No %s support available to open "%s": %s'
+               % (name, filename, e))
+        raise epylog.ConfigError(msg, logger)
+    except (IOError, EnvironmentError, zlib.error):
+        msg = ('Could not open file "%s" with %s handler. Not %s?'
+               % (filename, name, name))
+        raise epylog.ConfigError(msg, logger)
+    if seekable:
+        logger.put(5, '<log.open_compressed')
+        return fh
+    fd, ungzfile = tempfile.mkstemp('UNZIP', 'EPYLOG', tmpprefix)
+    logger.put(3, 'Inflating into a tempfile in "%s"' % ungzfile)
+    ungzfh = os.fdopen(fd, 'w+b')
+    try:
+        while 1:
+            chunk = fh.read(epylog.CHUNK_SIZE * 8)
+            if not chunk: break
+            ungzfh.write(chunk)
+    except Exception, e:
+        fh.close()
+        ungzfh.close()
+        msg = 'Error decompressing "%s" with %s: %s' % (filename, name, e)
+        raise epylog.ConfigError(msg, logger)
+    fh.close()
+    ungzfh.close()
+    ##
+    # Open it again by name, so it can be reopened later (see
+    # LogFile.reopen).
+    #
+    ungzfh = open(ungzfile, 'rb')
+    logger.put(5, '<log.open_compressed')
+    return ungzfh
+
+class InflatePool:
+    """
+    Decompresses rotated logs in a few worker threads ahead of the time
+    they are needed, so a range spanning several compressed logs does
+    not have to inflate them one after another. The decompressors do
+    their work with the GIL released. There is one pool for all the logs
+    of a LogTracker, with no more than "workers" threads at a time.
+    """
+    def __init__(self, tmpprefix, monthmap, vardir, workers, logger):
+        self.logger = logger
+        logger.put(5, '>InflatePool.__init__')
+        self.tmpprefix = tmpprefix
+        self.monthmap = monthmap
+        self.vardir = vardir
+        self.workers = workers
+        self.mon = threading.Lock()
+        ##
+        # jobs:    map of filenames to [event, fh, error, dropped]
+        # pending: filenames not yet picked up by a worker
+        # running: how many worker threads there are
+        # gzindex: the stored gzindex, loaded the first time it is needed
+        #
+        self.jobs = {}
+        self.pending = []
+        self.running = 0
+        self.gzindex = None
+        logger.put(5, '<InflatePool.__init__')
+
+    def prefetch(self, filenames):
+        """
+        Start decompressing these files in the background.
+        """
+        logger = self.logger
+        logger.put(5, '>InflatePool.prefetch')
+        self.mon.acquire()
+        for filename in filenames:
+            if filename in self.jobs: continue
+            decompressor = get_decompressor(filename)
+            if decompressor is None: continue
+            if decompressor[2]:
+                if gzindex_has(filename, self.monthmap, self._gzindex()):
+                    ##
+                    # Nothing to inflate until we actually read from it.
+                    #
+                    continue
+            logger.put(3, 'Queueing "%s" for decompression' % filename)
+            self.jobs[filename] = [threading.Event(), None, None, 0]
+            self.pending.append(filename)
+        nthreads = min(self.workers - self.running, len(self.pending))
+        if nthreads > 0: self.running += nthreads
+        self.mon.release()
+        for i in range(nthreads):
+            t = threading.Thread(target=self._work)
+            t.setDaemon(1)
+            t.start()
+        logger.put(5, '<InflatePool.prefetch')
+
+    def get(self, filename):
+        """
+        Wait for and return the decompressed file-like object for this
+        file, or None if it was never prefetched.
+        """
+        self.mon.acquire()
+        job = self.jobs.get(filename)
+        self.mon.release()
+        if job is None: return None
+        self.logger.put(3, 'Waiting for "%s" to be decompressed' % filename)
+        job[0].wait()
+        self.mon.acquire()
+        del self.jobs[filename]
+        self.mon.release()
+        if job[2] is not None: raise job[2]
+        return job[1]
+
+    def get_gzindex(self):
+        """
+        Return the gzindex, so the logs of this LogTracker do not all
+        load it again.
+        """
+        self.mon.acquire()
+        gzindex = self._gzindex()
+        self.mon.release()
+        return gzindex
+
+    def _gzindex(self):
+        if self.gzindex is None:
+            self.gzindex = load_state(self.vardir, GZINDEX_FILE,
+                                      self.logger) or {}
+        return self.gzindex
+
+    def discard(self, filenames):
+        """
+        Forget about these files if they were prefetched and not asked
+        for after all. The ones not yet started are never decompressed,
+        and whatever was or will be decompressed is closed.
+        """
+        self.mon.acquire()
+        for filename in filenames:
+            job = self.jobs.get(filename)
+            if job is None: continue
+            self.logger.put(3, 'Not decompressing "%s" after all' % filename)
+            del self.jobs[filename]
+            if filename in self.pending: self.pending.remove(filename)
+            elif job[0].isSet():
+                if job[1] is not None: job[1].close()
+            else: job[3] = 1
+        self.mon.release()
+
+    def _work(self):
+        """
+        Worker thread: decompress pending files until there are none left.
+        """
+        while 1:
+            self.mon.acquire()
+            if not self.pending:
+                self.running -= 1
+                self.mon.release()
+                break
+            filename = self.pending.pop(0)
+            job = self.jobs[filename]
+            self.mon.release()
+            try:
+                fh = open_compressed(filename, self.tmpprefix, self.logger)
+                if isinstance(fh, GzipLogReader):
+                    ##
+                    # Finding the end is what costs the full inflate.
+                    #
+                    fh.seek(0, 2)
+                job[1] = fh
+            except Exception, e:
+                job[2] = e
+            self.mon.acquire()
+            if job[3] and job[1] is not None: job[1].close()
+            job[0].set()
+            self.mon.release()
+
+##
+# gzindex keeps the stamps and end offsets of compressed rotated logs,
+# so they do not have to be inflated in full on every run.
+# stampindex keeps sparse (stamp, offset) samples for each logfile, so
+# timestamps can be located without searching through the log.
+# lastmessages keeps the last message from each host at the end of the
+# range, so "last message repeated" lines at the start of the next run
+# can be resolved without searching backwards.
+# regexstats keeps how often each regex of the internal modules matched.
+# State for logs not seen in STATE_EXPIRE seconds is dropped.
+# A ruleset file keeps the rules an internal module read and checked,
+# along with what they were read from, see InternalModule.load_ruleset.
+#
+GZINDEX_FILE = 'gzindex.pickle'
+STAMPINDEX_FILE = 'stampindex.pickle'
+LASTMSG_FILE = 'lastmessages.pickle'
+REGEXSTATS_FILE = 'regexstats.pickle'
+RULESET_FILE = 'ruleset-%s.pickle'
+STATE_EXPIRE = 60*60*24*60
+
+def gzindex_key(filename, monthmap):
+    """
+    Rotated logs are never modified, so inode and compressed size are
+    enough to recognize one we have already looked at. The monthmap
+    is part of the key, since the stamps depend on it.
+    """
+    st = os.stat(filename)
+    return (st.st_ino, st.st_size, monthmap_key(monthmap))
+
+def monthmap_key(monthmap):
+    """
+    Return a hashable version of the monthmap. Stamps stored across runs
+    are only good as long as the monthmap they were made with is.
+    """
+    months = monthmap.items()
+    months.sort()
+    return tuple(months)
+
+def gzindex_has(filename, monthmap, gzindex):
+    """
+    Check if this compressed log is already in the loaded gzindex.
+    """
+    if not gzindex: return 0
+    try: return gzindex_key(filename, monthmap) in gzindex
+    except OSError: return 0
+
+def load_state(vardir, name, logger):
+    """
+    Load a pickled piece of state kept across runs in vardir. Returns
+    None if there is no vardir, no such state, or it cannot be read.
+    """
+    logger.put(5, '>log.load_state')
+    if vardir is None:
+        logger.put(5, '<log.load_state')
+        return None
+    path = os.path.join(vardir, name)
+    state = None
+    if os.access(path, os.R_OK):
+        try:
+            fh = open(path, 'rb')
+            state = pickle.load(fh)
+            fh.close()
+            logger.put(3, 'Loaded state from "%s"' % path)
+        except Exception, e:
+            logger.put(3, 'Could not load state from "%s": %s' % (path, e))
+            state = None
+    logger.put(5, '<log.load_state')
+    return state
+
+def save_state(vardir, name, state, logger):
+    """
+    Pickle a piece of state into vardir. The state is written into a
+    temporary file first and renamed over the old one, so a crashed run
+    never leaves a half-written file behind.
+    """
+    logger.put(5, '>log.save_state')
+    if vardir is None:
+        logger.put(5, '<log.save_state')
+        return
+    path = os.path.join(vardir, name)
+    tmppath = '%s.%d' % (path, os.getpid())
+    try:
+        fh = open(tmppath, 'wb')
+        pickle.dump(state, fh, 1)
+        fh.close()
+        os.rename(tmppath, path)
+        logger.put(3, 'Saved state into "%s"' % path)
+    except (IOError, OSError), e:
+        logger.put(0, 'Could not save state into "%s": %s' % (path, e))
+    logger.put(5, '<log.save_state')
+
 class LogTracker:
     """
     This is a helper class to track the logfiles as requested by the modules,
@@ -113,9 +746,14 @@ class LogTracker:
         self.logger = logger
         logger.put(5, '>LogTracker.__init__')
         self.tmpprefix = config.tmpprefix
+        try: self.vardir = config.get('main', 'vardir')
+        except: self.vardir = None
         self.entries = []
         self.logs = []
         self.monthmap = mkmonthmap()
+        self.inflater = InflatePool(self.tmpprefix, self.monthmap,
+                                    self.vardir, epylog.INFLATE_THREADS,
+                                    logger)
         logger.put(5, '<LogTracker.__init__')
 
     def getlog(self, entry):
@@ -186,6 +824,27 @@ class LogTracker:
             raise epylog.NoSuchLogError(msg, logger)
         logger.put(5, '<LogTracker.set_offset_by_entry')
 
+    def store_last_messages(self):
+        """
+        Store the last message from each host for every log that was read
+        to the end, so the next run can use them. Should be done along
+        with storing the offset map.
+        """
+        logger = self.logger
+        logger.put(5, '>LogTracker.store_last_messages')
+        state = load_state(self.vardir, LASTMSG_FILE, logger)
+        if not isinstance(state, dict): state = {}
+        now = int(time.time())
+        for entry, value in state.items():
+            if now - value[3] > STATE_EXPIRE: del state[entry]
+        for log in self.logs:
+            laststate = log.get_last_messages_state()
+            if laststate is None: continue
+            inode, offset, table = laststate
+            state[log.entry] = (inode, offset, table, now)
+        save_state(self.vardir, LASTMSG_FILE, state, logger)
+        logger.put(5, '<LogTracker.store_last_messages')
+
     def dump_all_strings(self, fh):
         """
         Dumps all strings in the internal omap into a specified fh.
@@ -248,6 +907,14 @@ class LogTracker:
                 logger.put(0, msg)
         logger.put(5, '<LogTracker.set_offsets_by_timestamp')
         
+    def get_filenames(self):
+        """
+        Return the names of the current (not rotated) logfiles.
+        """
+        filenames = []
+        for log in self.logs: filenames.append(log.get_filename())
+        return filenames
+
     def _init_log_by_entry(self, entry):
         """
         Initialize a log object based on an entry specified.
@@ -255,7 +922,8 @@ class LogTracker:
         logger = self.logger
         logger.put(5, '>LogTracker._init_log_by_entry')
         logger.puthang(3, 'Initializing log object for entry "%s"' % entry)
-        log = Log(entry, self.tmpprefix, self.monthmap, self.logger)
+        log = Log(entry, self.tmpprefix, self.monthmap, self.logger,
+                  self.vardir, self.inflater)
         logger.endhang(3)
         self.entries.append(entry)
         self.logs.append(log)
@@ -277,6 +945,88 @@ class LogTracker:
         logger.put(5, '<LogTracker._get_log_by_entry')
         return None
 
+class LogWatcher:
+    """
+    Used when following the logs to wait until there is something new
+    in them. With pyinotify the directories of the logs are watched, so
+    an idle loghost is left alone until the report is due. Without it
+    we simply wake up every "poll" seconds and go look.
+    """
+    def __init__(self, filenames, poll, logger):
+        self.logger = logger
+        logger.put(5, '>LogWatcher.__init__')
+        self.poll = poll
+        self.filenames = {}
+        self.changed = 0
+        self.notifier = None
+        dirnames = {}
+        for filename in filenames:
+            filename = os.path.abspath(filename)
+            self.filenames[filename] = 1
+            dirnames[os.path.dirname(filename)] = 1
+        if pyinotify is None:
+            logger.put(3, 'No pyinotify, polling the logs every %d seconds'
+                       % poll)
+        else:
+            try:
+                wm = pyinotify.WatchManager()
+                mask = (pyinotify.IN_MODIFY | pyinotify.IN_CREATE |
+                        pyinotify.IN_MOVED_TO)
+                for dirname in dirnames.keys():
+                    logger.put(3, 'Watching "%s"' % dirname)
+                    wm.add_watch(dirname, mask, proc_fun=self._event)
+                self.notifier = pyinotify.Notifier(wm)
+            except Exception, e:
+                logger.put(0, 'Could not set up inotify (%s), polling' % e)
+                self.notifier = None
+        logger.put(5, '<LogWatcher.__init__')
+
+    def wait(self, timeout, stopped=None):
+        """
+        Wait until one of the logs changes, but no longer than "timeout"
+        seconds. Changes are looked at no more often than every "poll"
+        seconds, so a busy log gets read in chunks and not line by line.
+        If "stopped" is given, it is called every STOP_CHECK seconds, and
+        the wait is over as soon as it returns true. Returns true if the
+        logs may have changed.
+        """
+        logger = self.logger
+        logger.put(5, '>LogWatcher.wait')
+        now = time.time()
+        deadline = now + timeout
+        ##
+        # Signals do not cut the waiting short, so wait in slices and
+        # see if we were told to stop in between.
+        #
+        wake = now + max(0, min(self.poll, timeout))
+        while 1:
+            if stopped is not None and stopped():
+                logger.put(5, '<LogWatcher.wait')
+                return 0
+            left = wake - time.time()
+            if left <= 0: break
+            time.sleep(min(left, epylog.STOP_CHECK))
+        if self.notifier is None:
+            logger.put(5, '<LogWatcher.wait')
+            return 1
+        while not self.changed:
+            if stopped is not None and stopped(): break
+            left = min(deadline - time.time(), epylog.STOP_CHECK)
+            if left <= 0: break
+            if self.notifier.check_events(int(left * 1000)):
+                self.notifier.read_events()
+                self.notifier.process_events()
+        changed = self.changed
+        self.changed = 0
+        logger.put(5, '<LogWatcher.wait')
+        return changed
+
+    def _event(self, event):
+        """
+        Called by pyinotify for every event in the watched directories.
+        """
+        if event.pathname in self.filenames: self.changed = 1
+
 class OffsetRange:
     """
     This is a helper class that handles offset ranges. Since there can be
@@ -381,6 +1131,71 @@ class OffsetRange:
         logger.put(5, '<OffsetRange.is_inside')
         return cond
 
+    def split(self, count, loglist):
+        """
+        Split this range into up to "count" ranges of about the same size,
+        for processing them separately. Each starts at the beginning of a
+        line, and together they cover the same lines as this range, even
+        across rotated logs. They are returned in log order.
+        """
+        logger = self.logger
+        logger.put(5, '>OffsetRange.split')
+        self._recalc_total_size(loglist)
+        if count < 2 or self.total_size < count:
+            logger.put(5, '<OffsetRange.split')
+            return [self]
+        ##
+        # Find the boundaries first. A boundary is the first line of the
+        # next range.
+        #
+        bounds = []
+        last = (-self.startix, self.start_offset)
+        for i in range(1, count):
+            remaining = self.total_size * i / count
+            point = None
+            for ix in range(self.startix, self.endix - 1, -1):
+                if ix == self.startix: base = self.start_offset
+                else: base = 0
+                if ix == self.endix: top = self.end_offset
+                else: top = loglist[ix].end_offset
+                if remaining < top - base:
+                    point = (ix, base + remaining)
+                    break
+                remaining -= top - base
+            if point is None: continue
+            ix, offset = point
+            logfile = loglist[ix]
+            offset = logfile.next_line_start(offset)
+            if offset >= logfile.end_offset:
+                ##
+                # The last line of the logfile is not ours; the next range
+                # starts with the next logfile.
+                #
+                if ix == self.endix: continue
+                ix, offset = ix - 1, 0
+            if ix == self.endix and offset > self.end_offset: continue
+            if (-ix, offset) <= last: continue
+            last = (-ix, offset)
+            bounds.append((ix, offset))
+        ##
+        # Now make the ranges. The end of a range is inclusive, so it
+        # has to point inside the line before the boundary.
+        #
+        ranges = []
+        startix, start_offset = self.startix, self.start_offset
+        for ix, offset in bounds:
+            if offset > 0: endix, end_offset = ix, offset - 1
+            else: endix, end_offset = ix + 1, loglist[ix + 1].end_offset
+            ranges.append(OffsetRange(startix, start_offset, endix,
+                                      end_offset, logger))
+            startix, start_offset = ix, offset
+        ranges.append(OffsetRange(startix, start_offset, self.endix,
+                                  self.end_offset, logger))
+        for orange in ranges: orange._recalc_total_size(loglist)
+        logger.put(3, 'Split the range into %d ranges' % len(ranges))
+        logger.put(5, '<OffsetRange.split')
+        return ranges
+
     def _recalc_total_size(self, loglist):
         """
         If the offsets change, recalculate total size of the range.
@@ -427,11 +1242,14 @@ class Log:
     This class is the collection of LogFile objects all belonging to the same
     entry.. It handles things like reading from files, looking up lines, etc.
     """
-    def __init__(self, entry, tmpprefix, monthmap, logger):
+    def __init__(self, entry, tmpprefix, monthmap, logger, vardir=None,
+                 inflater=None):
         logger.put(5, '>Log.__init__')
         logger.puthang(3, 'Initializing Log object for entry "%s"' % entry)
         self.logger = logger
         self.tmpprefix = tmpprefix
+        self.vardir = vardir
+        self.inflater = inflater
         self.monthmap = monthmap
         self.entry = entry
         filename = self._get_filename()
@@ -439,7 +1257,7 @@ class Log:
         self.loglist = []
         self.cur_rot_ix = 0
         try:
-            logfile = LogFile(filename, tmpprefix, monthmap, logger)
+            logfile = LogFile(filename, tmpprefix, monthmap, logger, vardir)
             logger.put(3, 'Appending logfile to the loglist')
             self.loglist.append(logfile)
         except epylog.EmptyLogError:
@@ -452,6 +1270,23 @@ class Log:
         self.orange = OffsetRange(0, 0, 0, logfile.end_offset, logger)
         logger.endhang(3)
         self.lp = None
+        ##
+        # last_messages: the last message from each system, kept up to
+        #                date as lines are read, for resolving the "last
+        #                message repeated" lines.
+        # last_complete: set once last_messages describes the end of the
+        #                range, so it can be stored for the next run.
+        # host_res:      regexes for finding lines by system, in case we
+        #                have to search backwards after all.
+        #
+        self.last_messages = {}
+        self.last_complete = 0
+        self.host_res = {}
+        ##
+        # follow_range: when following the logs, the range last returned
+        #               by refresh(), which the next one continues.
+        #
+        self.follow_range = None
         logger.put(5, '<Log.__init__')
 
     def set_range_param(self, ix, offset, whence=0):
@@ -486,6 +1321,150 @@ class Log:
                 self.orange.setstart(ix, offset, self.loglist)
         logger.put(5, '<Log.set_range_param')
 
+    def load_last_messages(self):
+        """
+        Start last_messages from the table stored by the previous run, if
+        that run ended right where this range starts.
+        """
+        logger = self.logger
+        logger.put(5, '>Log.load_last_messages')
+        self.last_messages = {}
+        self.last_complete = 0
+        state = load_state(self.vardir, LASTMSG_FILE, logger)
+        try:
+            inode, offset, table, used = state[self.entry]
+            startlog = self.loglist[self.orange.startix]
+            if (inode == startlog.getinode()
+                and offset == self.orange.start_offset):
+                logger.put(3, 'Using the stored last messages for "%s"'
+                           % self.entry)
+                self.last_messages = table.copy()
+            else:
+                logger.put(3, 'Stored last messages for "%s" do not match '
+                           'the start of the range' % self.entry)
+        except (KeyError, TypeError, ValueError, OSError):
+            logger.put(3, 'No stored last messages for "%s"' % self.entry)
+        logger.put(5, '<Log.load_last_messages')
+
+    def get_last_messages_state(self):
+        """
+        Return the (inode, offset, table) to store for the next run, or
+        None if the range was not read to the end. The inode and offset
+        are where the next run will start, as recorded in the offset map.
+        """
+        if not self.last_complete or self.orange.endix != 0: return None
+        return (self.getinode(), self.orange.end_offset,
+                self.last_messages)
+
+    def get_shards(self, count):
+        """
+        Split the offset range into up to "count" line-aligned ranges that
+        can be processed separately with iterlines().
+        """
+        return self.orange.split(count, self.loglist)
+
+    def reopen(self):
+        """
+        Reopen all logfiles. Must be called in a forked process before
+        reading anything.
+        """
+        for logfile in self.loglist: logfile.reopen()
+
+    def refresh(self):
+        """
+        Used when following the logs. Pick up the lines appended to the
+        log since the last call, noticing if it was rotated or truncated
+        in the meantime. The offset range is extended to the new end, and
+        a range with just the new lines is returned, or None if there are
+        none. The first call returns the whole offset range.
+        """
+        logger = self.logger
+        logger.put(5, '>Log.refresh')
+        if self.follow_range is None:
+            self.follow_range = self.orange
+            logger.put(5, '<Log.refresh')
+            return self.orange
+        filename = self._get_filename()
+        current = self.loglist[0]
+        try:
+            stat = os.stat(filename)
+            inode = os.fstat(current.fh.fileno()).st_ino
+        except (OSError, AttributeError):
+            ##
+            # Caught in the middle of the rotation, or the current log is
+            # compressed and cannot be growing anyway.
+            #
+            logger.put(3, 'Cannot look at "%s" right now' % filename)
+            logger.put(5, '<Log.refresh')
+            return None
+        endix = self.orange.endix
+        end_offset = self.orange.end_offset
+        newlog = None
+        if stat.st_ino != inode or stat.st_size < current.end_offset:
+            try:
+                newlog = LogFile(filename, self.tmpprefix, self.monthmap,
+                                 logger, self.vardir)
+            except epylog.EmptyLogError:
+                logger.put(3, 'New "%s" is still empty' % filename)
+            except epylog.AccessError, e:
+                logger.put(0, str(e))
+        if newlog is not None and stat.st_ino != inode:
+            logger.put(1, '"%s" was rotated' % filename)
+            current.seal()
+            try:
+                rotname = self._get_rotname_by_ix(1)
+                if os.stat(rotname).st_ino == inode: current.filename = rotname
+            except (epylog.NoSuchLogError, epylog.ConfigError, OSError):
+                pass
+            self.loglist.insert(0, newlog)
+            self.cur_rot_ix += 1
+            endix += 1
+            self.orange.setstart(self.orange.startix + 1,
+                                 self.orange.start_offset, self.loglist)
+            if self.lp is not None: self.lp.ix += 1
+        elif newlog is not None:
+            logger.put(0, '"%s" was truncated, starting over' % filename)
+            current.close()
+            self.loglist[0] = newlog
+            endix = end_offset = 0
+            if self.orange.startix == 0:
+                self.orange.setstart(0, 0, self.loglist)
+            self.last_messages = {}
+        elif stat.st_ino == inode and stat.st_size < current.end_offset:
+            logger.put(3, 'Waiting for "%s" to be written to' % filename)
+            logger.put(5, '<Log.refresh')
+            return None
+        elif not current.refresh():
+            logger.put(5, '<Log.refresh')
+            return None
+        end = self.loglist[0].end_offset
+        self.orange.setend(0, end, self.loglist)
+        self.follow_range = OffsetRange(endix, end_offset, 0, end, logger)
+        self.follow_range._recalc_total_size(self.loglist)
+        logger.put(5, '<Log.refresh')
+        return self.follow_range
+
+    def start_new_range(self):
+        """
+        Used when following the logs. Start the next offset range where
+        this one ends, and let go of the rotated logfiles that are not
+        needed any more.
+        """
+        logger = self.logger
+        logger.put(5, '>Log.start_new_range')
+        endix = self.orange.endix
+        end_offset = self.orange.end_offset
+        for logfile in self.loglist[endix+1:]:
+            logger.put(3, 'Done with "%s"' % logfile.filename)
+            logfile.close()
+        del self.loglist[endix+1:]
+        self.cur_rot_ix = len(self.loglist) - 1
+        self.orange = OffsetRange(endix, end_offset, endix, end_offset,
+                                  logger)
+        self.orange._recalc_total_size(self.loglist)
+        self.lp = None
+        logger.put(5, '<Log.start_new_range')
+
     def getinode(self):
         """
         Get the inode of the file at index 0 (current logfile).
@@ -512,6 +1491,7 @@ class Log:
             logger.put(5, 'setting init linepointer with ix=%d, offset=%d' %
                        (ix, offset))
             self.lp = LinePointer(ix, offset, logger)
+            self.load_last_messages()
         ix = self.lp.ix
         offset = self.lp.offset
         logger.put(3, 'Checking if we are past the orange end')
@@ -529,30 +1509,112 @@ class Log:
             ix -= 1
             offset = 0
         self.lp.set(ix, offset)
-        try:
-            stamp, system, message = get_stamp_sys_msg(line, self.monthmap)
-            multiplier = 1
-            mo = epylog.MESSAGE_REPEATED_RE.search(message)
-            if mo:
-                try:
-                    message = self._lookup_repeated(system)
-                    multiplier = int(mo.group(1))
-                except epylog.FormatError: pass
-                except epylog.GenericError: pass
-            log.repeated_cache[system] = message
-            linemap = {'line': line,
-                       'stamp': stamp,
-                       'system': system,
-                       'message': message,
-                       'multiplier': multiplier}
-        except ValueError:
-            logger.put(0, 'Invalid syslog format string in %s: %s' %
-                       (log.filename, line))
+        linemap = self._mk_linemap(log, line)
+        if linemap.message is None:
             # Pass it on
             raise epylog.FormatError(line, logger)
         logger.put(5, '<Log.nextline')
         return linemap
 
+    def iterlines(self, batch=None, orange=None, progress=1):
+        """
+        A generator that walks the whole offset range and yields lists
+        of up to "batch" linemaps at a time. Range checks and the progress
+        bar are only updated once per batch, which is a lot cheaper than
+        calling nextline() for every line. Lines that are not in syslog
+        format are passed through with only the "line" key meaningful and
+        "message" set to None, so the caller can put them into unparsed.
+        To walk only a part of the range, pass one of the ranges returned
+        by get_shards() as "orange".
+        """
+        logger = self.logger
+        logger.put(5, '>Log.iterlines')
+        if batch is None: batch = epylog.LINE_BATCH
+        if orange is None: orange = self.orange
+        else: self.lp = None
+        ix = orange.startix
+        offset = orange.start_offset
+        total = orange.total_size
+        if self.lp is None: self.lp = LinePointer(ix, offset, logger)
+        if orange is self.follow_range and orange is not self.orange:
+            ##
+            # Following the logs: this range continues the previous one,
+            # so last_messages are still good.
+            #
+            pass
+        elif ix == self.orange.startix and offset == self.orange.start_offset:
+            self.load_last_messages()
+        else:
+            ##
+            # Nothing is known about what came before this shard.
+            #
+            self.last_messages = {}
+        lp = self.lp
+        while orange.is_inside(ix, offset):
+            log = self.loglist[ix]
+            ##
+            # Lines starting at or past the end of the initialized log
+            # are not ours. In the last log of the range, the line
+            # starting right at the end offset still is.
+            #
+            limit = log.end_offset
+            if ix == orange.endix and orange.end_offset < limit:
+                limit = orange.end_offset + 1
+            lines, endoffset = log.get_lines_at_offset(offset, limit, batch)
+            if not lines:
+                logger.put(3, 'No more lines in "%s"' % log.filename)
+                break
+            linemaps = []
+            parsed = split_syslog_lines(lines)
+            for i in range(len(lines)):
+                line = lines[i]
+                offset += len(line)
+                if offset >= log.end_offset:
+                    lp.ix = ix - 1
+                    lp.offset = 0
+                else:
+                    lp.ix = ix
+                    lp.offset = offset
+                linemaps.append(self._mk_linemap(log, line, parsed[i]))
+            if progress:
+                done = orange.done_size(ix, offset, self.loglist)
+                logger.progressbar(1, log.filename, done, total)
+            if offset >= log.end_offset:
+                logger.put(3, 'End of log "%s" reached' % log.filename)
+                ix -= 1
+                offset = 0
+            yield linemaps
+        if orange is self.orange or orange is self.follow_range:
+            self.last_complete = 1
+        logger.put(5, '<Log.iterlines')
+
+    def _mk_linemap(self, log, line, parsed=None):
+        """
+        Make a LineRecord out of a line read from the logfile, unwrapping
+        the "last message repeated" lines as necessary. The line pointer
+        must already point past this line. If the line cannot be parsed,
+        the message in the record is None. If the line was already split
+        with split_syslog_lines, pass its result as "parsed".
+        """
+        try:
+            if parsed is None: parsed = split_syslog_line(line)
+            datestr, system, message = parsed
+        except ValueError:
+            self.logger.put(0, 'Invalid syslog format string in %s: %s' %
+                            (log.filename, line))
+            return LineRecord(line, None, None, 0, -1)
+        multiplier = 1
+        mo = epylog.MESSAGE_REPEATED_RE.search(message)
+        if mo:
+            try:
+                message = self._lookup_repeated(system)
+                multiplier = int(mo.group(1))
+            except epylog.FormatError: pass
+            except epylog.GenericError: pass
+        self.last_messages[system] = message
+        return LineRecord(line, system, message, multiplier,
+                          datestr=datestr, monthmap=self.monthmap)
+
     def _lookup_repeated(self, system):
         """
         A helper method to resolve the pesky 'last message repeated' lines.
@@ -562,12 +1624,15 @@ class Log:
         logger.put(5, '>Log._lookup_repeated')
         log = self.loglist[self.lp.ix]
         try:
-            message = log.repeated_cache[system]
-            logger.put(3, 'Found in repeated_cache by system')
+            message = self.last_messages[system]
+            logger.put(3, 'Found in last_messages by system')
             logger.put(5, '<Log._lookup_repeated')
             return message
         except KeyError: pass
-        host_re = re.compile('.{15,15} .*[@/]*%s' % system)
+        try: host_re = self.host_res[system]
+        except KeyError:
+            host_re = re.compile('.{15,15} .*[@/]*%s' % system)
+            self.host_res[system] = host_re
         offset = self.lp.offset
         logger.put(3, 'Looking in "%s" for the previous report from %s' %
                    (log.filename, system))
@@ -685,6 +1750,22 @@ class Log:
             raise epylog.OutOfRangeError(msg, logger)
         logger.put(5, 'looking for start_stamp=%d' % start_stamp)
         logger.put(5, 'looking for end_stamp=%d' % end_stamp)
+        prefetched = self._prefetch_rotfiles(start_stamp)
+        try: self._find_range(start_stamp, end_stamp)
+        finally:
+            ##
+            # The walk may have stopped before the ones it was thought
+            # to need.
+            #
+            if prefetched: self.inflater.discard(prefetched)
+        logger.put(5, '<Log.set_range_by_timestamps')
+
+    def _find_range(self, start_stamp, end_stamp):
+        """
+        Walk back through the logs to find the range between the stamps.
+        """
+        logger = self.logger
+        logger.put(5, '>Log._find_range')
         ix = 0
         start_offset = None
         end_offset = None
@@ -756,7 +1837,7 @@ class Log:
         logger.put(5, 'end_offset=%d' % end_offset)
         self.orange.setstart(start_ix, start_offset, self.loglist)
         self.orange.setend(end_ix, end_offset, self.loglist)
-        logger.put(5, '<Log.set_range_by_timestamps')
+        logger.put(5, '<Log._find_range')
 
     def is_range_empty(self):
         """
@@ -818,7 +1899,8 @@ class Log:
         rotname = self._get_rotname_by_ix(self.cur_rot_ix)
         try:
             logger.put(3, 'Initializing log for rotated file "%s"' % rotname)
-            rotlog = LogFile(rotname, self.tmpprefix, self.monthmap, logger)
+            rotlog = LogFile(rotname, self.tmpprefix, self.monthmap, logger,
+                             self.vardir, self.inflater)
             self.loglist.append(rotlog)
         except epylog.AccessError:
             msg = 'No further rotated files for entry "%s"' % self.entry
@@ -829,6 +1911,35 @@ class Log:
         logger.put(5, '<Log._init_next_rotfile')
         return rotlog
 
+    def _prefetch_rotfiles(self, start_stamp):
+        """
+        Figure out which not yet initialized rotated logs the walk back to
+        start_stamp is going to need and have the inflater decompress
+        them all at once. A rotated log was last written to around its
+        mtime, so everything newer than start_stamp is needed, plus the
+        first one older than that, where the walk will stop. Returns the
+        names of the ones prefetched.
+        """
+        logger = self.logger
+        logger.put(5, '>Log._prefetch_rotfiles')
+        if self.inflater is None:
+            logger.put(5, '<Log._prefetch_rotfiles')
+            return []
+        rotnames = []
+        ix = self.cur_rot_ix + 1
+        while 1:
+            try:
+                rotname = self._get_rotname_by_ix(ix)
+                mtime = os.stat(rotname).st_mtime
+            except (epylog.NoSuchLogError, epylog.ConfigError, OSError):
+                break
+            rotnames.append(rotname)
+            if mtime < start_stamp: break
+            ix += 1
+        if rotnames: self.inflater.prefetch(rotnames)
+        logger.put(5, '<Log._prefetch_rotfiles')
+        return rotnames
+
     def _get_rotname_by_ix(self, ix):
         """
         Figure out the rotated file name by index passed.
@@ -861,6 +1972,12 @@ class Log:
         logger.put(5, '<Log._get_rotname_by_ix')
         return rotname
 
+    def get_filename(self):
+        """
+        Return the name of the current logfile of this entry.
+        """
+        return self._get_filename()
+
     def _get_filename(self):
         """
         Helper function to return the filename of the entry without any
@@ -879,10 +1996,13 @@ class LogFile:
     This class handles the log files themselves -- things like opening,
     rewinding, reading, etc.
     """
-    def __init__(self, filename, tmpprefix, monthmap, logger):
+    def __init__(self, filename, tmpprefix, monthmap, logger, vardir=None,
+                 inflater=None):
         self.logger = logger
         logger.put(5, '>LogFile.__init__')
         self.tmpprefix = tmpprefix
+        self.vardir = vardir
+        self.inflater = inflater
         self.filename = filename
         self.monthmap = monthmap
         ##
@@ -906,6 +2026,16 @@ class LogFile:
         #                 also a map of last lines for systems.
         #
         self.repeated_cache = {}
+        ##
+        # mm: read-only memory map of the file, or None if the file
+        #     could not be mapped and we are using the buffered reader.
+        #
+        self.mm = None
+        ##
+        # stampindex: sparse list of (stamp, offset) samples, loaded or
+        #             built the first time we need to find a timestamp
+        #
+        self.stampindex = None
         
         logger.put(3, 'Running sanity checks on the logfile')
         self._accesscheck()
@@ -917,41 +2047,37 @@ class LogFile:
     def _initfile(self):
         """
         Initialize the logfile. This usually consitutes opening it,
-        figuring out if it's gzipped or not, and recording where the log
+        figuring out if it's compressed or not, and recording where the log
         ends. That is important, as logs are usually being appended during
         epylog runs.
         """
         logger = self.logger
         logger.put(5, '>LogFile._initfile')
-        logger.put(3, 'Checking if we are gzipped (ends in .gz)')
-        if re.compile('\.gz$').search(self.filename, 1):
-            logger.put(3, 'Ends in .gz. Using GzipFile to open')
-            import gzip
-            tempfile.tmpdir = self.tmpprefix
-            ungzfile = tempfile.mktemp('UNGZ')
-            logger.put(3, 'Creating a tempfile in "%s"' % ungzfile)
-            ungzfh = open(tempfile.mktemp('UNGZ'), 'w+')
-            try:
-                gzfh = gzip.open(self.filename)
-            except:
-                raise epylog.ConfigError(('Could not open file "%s" with'
-                                          + ' gzip handler. Not gzipped?')
-                                         % self.filename, logger)
-            logger.put(3, 'Putting the contents of the gzlog into ungzlog')
-            while 1:
-                chunk = gzfh.read(epylog.CHUNK_SIZE)
-                if chunk:
-                    ungzfh.write(chunk)
-                    logger.put(5, 'Read "%s" bytes from gzfh' % len(chunk))
-                else:
-                    logger.put(5, 'Reached EOF')
-                    break
-            gzfh.close()
-            self.fh = ungzfh
+        logger.put(3, 'Checking if we are compressed')
+        gzipped = 0
+        decompressor = get_decompressor(self.filename)
+        if decompressor is not None:
+            logger.put(3, 'Looks like %s, decompressing' % decompressor[0])
+            self.fh = None
+            if self.inflater is not None:
+                self.fh = self.inflater.get(self.filename)
+            if self.fh is None:
+                self.fh = open_compressed(self.filename, self.tmpprefix,
+                                          logger)
+            if isinstance(self.fh, GzipLogReader):
+                gzipped = 1
+                if self._load_gzindex():
+                    logger.put(3, 'Found "%s" in gzindex, not inflating'
+                               % self.filename)
+                    logger.put(5, '<LogFile._initfile')
+                    return
+            else:
+                self._mapfile()
         else:
-            logger.put(3, 'Does not end in .gz, assuming plain text')
+            logger.put(3, 'Does not look compressed, assuming plain text')
             logger.put(3, 'Opening logfile "%s"' % self.filename)
             self.fh = open(self.filename)
+            self._mapfile()
         logger.put(3, 'Finding the start_stamp')
         self.fh.seek(0)
         self.start_stamp = self._get_stamp()
@@ -964,8 +2090,79 @@ class LogFile:
         logger.put(3, 'Finding the end_stamp')
         self.end_stamp = self._get_stamp()
         logger.put(5, 'end_stamp=%d' % self.end_stamp)
+        if gzipped: self._store_gzindex()
         logger.put(5, '<LogFile._initfile')
 
+    def _load_gzindex(self):
+        """
+        Look up the stamps and the end offset of this compressed log in the
+        gzindex kept in vardir. Returns true if they were found, in which
+        case nothing needs to be inflated until lines are actually read.
+        """
+        logger = self.logger
+        logger.put(5, '>LogFile._load_gzindex')
+        if self.inflater is not None: gzindex = self.inflater.get_gzindex()
+        else: gzindex = load_state(self.vardir, GZINDEX_FILE, logger)
+        found = 0
+        if gzindex:
+            try:
+                key = gzindex_key(self.filename, self.monthmap)
+                entry = gzindex[key]
+                (self.start_stamp, self.end_stamp,
+                 self.end_offset) = entry[:3]
+                self.range_end = self.end_offset
+                found = 1
+            except (KeyError, ValueError, TypeError):
+                logger.put(3, 'No usable gzindex entry for "%s"'
+                           % self.filename)
+        logger.put(5, '<LogFile._load_gzindex')
+        return found
+
+    def _store_gzindex(self):
+        """
+        Remember the stamps and the end offset of this compressed log, and
+        drop entries for logs that have not been seen for a while.
+        """
+        logger = self.logger
+        logger.put(5, '>LogFile._store_gzindex')
+        if self.vardir is None:
+            logger.put(5, '<LogFile._store_gzindex')
+            return
+        gzindex = load_state(self.vardir, GZINDEX_FILE, logger)
+        if not isinstance(gzindex, dict): gzindex = {}
+        now = int(time.time())
+        for key, entry in gzindex.items():
+            if now - entry[3] > STATE_EXPIRE: del gzindex[key]
+        key = gzindex_key(self.filename, self.monthmap)
+        gzindex[key] = (self.start_stamp, self.end_stamp, self.end_offset, now)
+        save_state(self.vardir, GZINDEX_FILE, gzindex, logger)
+        if self.inflater is not None: self.inflater.gzindex = gzindex
+        logger.put(5, '<LogFile._store_gzindex')
+
+    def _mapfile(self):
+        """
+        Try to memory-map the opened file, so lines can be looked up
+        by searching the mapping instead of seeking and reading the
+        file handle. If the file cannot be mapped (mmap is not available,
+        the file is empty, or the OS refuses), the buffered file handle
+        is used for everything.
+        """
+        logger = self.logger
+        logger.put(5, '>LogFile._mapfile')
+        if mmap is None:
+            logger.put(3, 'mmap not available, using buffered reads')
+            logger.put(5, '<LogFile._mapfile')
+            return
+        try:
+            self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+            logger.put(3, 'Mapped %d bytes of "%s"' % (len(self.mm),
+                                                       self.filename))
+        except (mmap.error, EnvironmentError, ValueError), e:
+            logger.put(3, 'Could not map "%s" (%s), using buffered reads'
+                       % (self.filename, e))
+            self.mm = None
+        logger.put(5, '<LogFile._mapfile')
+
     def set_offset_range(self, start, end):
         """
         A two-dimensional coordinate is accepted that points to which
@@ -994,6 +2191,90 @@ class LogFile:
         logger.put(5, 'range_end=%d' % self.range_end)
         logger.put(5, '<LogFile.set_offset_range')
 
+    def reopen(self):
+        """
+        Open the logfile again. A forked process must do this before
+        reading, since the file position is shared with the parent.
+        """
+        logger = self.logger
+        logger.put(5, '>LogFile.reopen')
+        offset = self.fh.tell()
+        if isinstance(self.fh, GzipLogReader):
+            self.fh.reopen()
+        else:
+            self.fh = open(self.fh.name)
+        self.fh.seek(offset)
+        logger.put(5, '<LogFile.reopen')
+
+    def refresh(self):
+        """
+        Pick up the lines appended to the logfile since it was opened.
+        Returns true if the end of the log has moved.
+        """
+        logger = self.logger
+        logger.put(5, '>LogFile.refresh')
+        try: size = os.fstat(self.fh.fileno()).st_size
+        except AttributeError:
+            ##
+            # Compressed logs do not grow.
+            #
+            logger.put(5, '<LogFile.refresh')
+            return 0
+        if self.mm is not None:
+            if len(self.mm) == size:
+                logger.put(5, '<LogFile.refresh')
+                return 0
+            self.mm.close()
+            self.mm = None
+            self._mapfile()
+        end_offset = self.end_offset
+        self.fh.seek(0, 2)
+        self._set_at_line_start()
+        self.end_offset = self.fh.tell()
+        self.range_end = self.end_offset
+        if self.end_offset == end_offset:
+            logger.put(5, '<LogFile.refresh')
+            return 0
+        logger.put(3, '"%s" now ends at %d' % (self.filename, self.end_offset))
+        self.end_stamp = self._get_stamp()
+        self.stampindex = None
+        logger.put(5, '<LogFile.refresh')
+        return 1
+
+    def seal(self):
+        """
+        Called once the logfile has been rotated away and will not grow
+        any more. Its last line is then read like all the others, so the
+        end offset is moved past it.
+        """
+        logger = self.logger
+        logger.put(5, '>LogFile.seal')
+        self.refresh()
+        self.fh.seek(0, 2)
+        self.end_offset = self.fh.tell()
+        self.range_end = self.end_offset
+        logger.put(5, '<LogFile.seal')
+
+    def close(self):
+        """
+        Close the logfile.
+        """
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        self.fh.close()
+
+    def next_line_start(self, offset):
+        """
+        Return the offset of the first line starting at or after the
+        offset passed.
+        """
+        if offset <= 0: return 0
+        start, end = find_line_start(self.fh, offset - 1, self.mm)
+        if start == offset: return offset
+        line, offset = self.get_line_at_offset(start)
+        return offset
+
     def getinode(self):
         """
         Return the inode of this logfile.
@@ -1044,13 +2325,165 @@ class LogFile:
         if self.stamp_in_log(searchstamp) != 0:
             msg = 'This stamp does not appear to be in this log'
             raise epylog.OutOfRangeError(msg, logger)
-        self._crude_locate(searchstamp)
-        self._fine_locate(searchstamp)
-        offset = self.fh.tell()
+        samples = self._get_stampindex()
+        if samples:
+            offset = self._index_locate(searchstamp, samples)
+        else:
+            logger.put(3, 'No stampindex, searching through the file')
+            self._crude_locate(searchstamp)
+            self._fine_locate(searchstamp)
+            offset = self.fh.tell()
         logger.put(5, 'offset=%d' % offset)
         logger.put(5, '<LogFile.find_offset_by_timestamp')
         return offset
 
+    def _index_locate(self, stamp, samples):
+        """
+        Find the first line with a timestamp at or past the stamp, using
+        the stampindex samples to only look at the lines between the last
+        sample before the stamp and the one after it.
+        """
+        logger = self.logger
+        logger.put(5, '>LogFile._index_locate')
+        stamps = [sample[0] for sample in samples]
+        ix = bisect.bisect_left(stamps, stamp)
+        if ix > 0: offset = samples[ix-1][1]
+        else: offset = 0
+        if ix < len(samples): limit = samples[ix][1]
+        else: limit = self.end_offset
+        logger.put(5, 'scanning from %d to %d' % (offset, limit))
+        monthmap = self.monthmap
+        while offset < limit:
+            lines, junk = self.get_lines_at_offset(offset, limit,
+                                                   epylog.LINE_BATCH)
+            if not lines: break
+            for line in lines:
+                if mkstamp_from_syslog_datestr(line, monthmap) >= stamp:
+                    logger.put(5, '<LogFile._index_locate')
+                    return offset
+                offset += len(line)
+        if offset > self.end_offset: offset = self.end_offset
+        logger.put(5, '<LogFile._index_locate')
+        return offset
+
+    def _get_stampindex(self):
+        """
+        Return the stampindex samples for this file. They are kept in
+        vardir by device and inode. If the file has grown since they were
+        stored, only the part past the last sample is looked at. Big
+        files are sampled further apart, so there are never more than
+        STAMPINDEX_SAMPLES of them.
+        """
+        logger = self.logger
+        logger.put(5, '>LogFile._get_stampindex')
+        if self.stampindex is not None:
+            logger.put(5, '<LogFile._get_stampindex')
+            return self.stampindex
+        st = os.stat(self.filename)
+        key = (st.st_dev, st.st_ino)
+        months = monthmap_key(self.monthmap)
+        state = load_state(self.vardir, STAMPINDEX_FILE, logger)
+        if not isinstance(state, dict): state = {}
+        samples = []
+        try:
+            size, mtime, end, smonths, samples, used = state[key]
+            if smonths != months or size > st.st_size:
+                logger.put(3, 'Stored stampindex is stale, rebuilding')
+                samples = []
+            elif size == st.st_size and mtime == st.st_mtime:
+                logger.put(3, 'Stored stampindex is current')
+            elif samples and not (self._check_sample(samples[0])
+                                  and self._check_sample(samples[-1])):
+                ##
+                # Rewritten, or another file got the inode.
+                #
+                logger.put(3, 'Log was rewritten, rebuilding the stampindex')
+                samples = []
+        except (KeyError, ValueError, TypeError):
+            logger.put(3, 'No stored stampindex for "%s"' % self.filename)
+            samples = []
+        spacing = max(epylog.STAMPINDEX_SPACING,
+                      self.end_offset / epylog.STAMPINDEX_SAMPLES + 1)
+        if samples: start = samples[-1][1] + spacing
+        else: start = 0
+        if start < self.end_offset:
+            logger.put(3, 'Sampling stamps from offset %d' % start)
+            samples = samples + self._sample_stamps(start, self.end_offset,
+                                                    spacing)
+        ##
+        # The ones taken while the file was smaller are closer together.
+        #
+        while len(samples) > epylog.STAMPINDEX_SAMPLES:
+            samples = samples[::2]
+        self.stampindex = samples
+        if self.vardir is not None:
+            now = int(time.time())
+            for key, entry in state.items():
+                if now - entry[5] > STATE_EXPIRE: del state[key]
+            state[key] = (st.st_size, st.st_mtime, self.end_offset,
+                                months, samples, now)
+            save_state(self.vardir, STAMPINDEX_FILE, state, logger)
+        logger.put(5, '<LogFile._get_stampindex')
+        return samples
+
+    def _check_sample(self, sample):
+        """
+        Check that the line at a stored sample still has the same stamp.
+        """
+        stamp, offset = sample
+        if offset > self.end_offset: return 0
+        line, junk = self.get_line_at_offset(offset)
+        return mkstamp_from_syslog_datestr(line, self.monthmap) == stamp
+
+    def _sample_stamps(self, start, end, spacing):
+        """
+        Take a (stamp, offset) sample of the first line starting at or
+        after every "spacing" bytes between start and end.
+        Lines that have no timestamp we understand are not sampled.
+        """
+        logger = self.logger
+        logger.put(5, '>LogFile._sample_stamps')
+        monthmap = self.monthmap
+        samples = []
+        mm = self.mm
+        if mm is not None and end <= len(mm):
+            ##
+            # Jump straight to every sampling point.
+            #
+            offset = start
+            while offset <= end:
+                if offset > 0:
+                    offset = mm.find('\n', offset - 1)
+                    if offset == -1: break
+                    offset += 1
+                if offset > end: break
+                stamp = mkstamp_from_syslog_datestr(mm[offset:offset+32],
+                                                    monthmap)
+                if stamp > 0: samples.append((stamp, offset))
+                offset += spacing
+        else:
+            ##
+            # Have to read through it.
+            #
+            self.fh.seek(start)
+            if start > 0: self._set_at_line_start()
+            offset = self.fh.tell()
+            nextsample = offset
+            readline = self.fh.readline
+            while offset <= end:
+                line = readline()
+                if not line: break
+                if offset >= nextsample:
+                    stamp = mkstamp_from_syslog_datestr(line, monthmap)
+                    if stamp > 0:
+                        samples.append((stamp, offset))
+                        nextsample = offset + spacing
+                offset += len(line)
+        logger.put(3, 'Took %d stamp samples from "%s"' % (len(samples),
+                                                           self.filename))
+        logger.put(5, '<LogFile._sample_stamps')
+        return samples
+
     def dump_strings(self, fh):
         """
         Dump all strings from this logfile into a provided fh. Only the
@@ -1065,6 +2498,18 @@ class LogFile:
         logger.put(5, 'range_start=%d' % self.range_start)
         logger.put(5, 'range_end=%d' % self.range_end)
         logger.put(5, 'chunklen=%d' % chunklen)
+        if self.mm is not None and self.range_end <= len(self.mm):
+            ##
+            # Write straight out of the mapping.
+            #
+            offset = self.range_start
+            while offset < self.range_end:
+                chunkend = min(offset + epylog.CHUNK_SIZE, self.range_end)
+                fh.write(self.mm[offset:chunkend])
+                offset = chunkend
+            logger.put(5, 'wrote %d bytes from %s to %s' %
+                       (chunklen, self.filename, fh.name))
+            return chunklen
         self.fh.seek(self.range_start)
         if chunklen > 0:
             iternum = int(chunklen/epylog.CHUNK_SIZE)
@@ -1107,12 +2552,58 @@ class LogFile:
         """
         logger = self.logger
         logger.put(5, '>LogFile.get_line_at_offset')
+        if self.mm is not None:
+            end = self.mm.find('\n', offset)
+            if end != -1:
+                end += 1
+                line = self.mm[offset:end]
+                logger.put(5, '<LogFile.get_line_at_offset')
+                return [line, end]
+            ##
+            # Either past the mapped area, or the last line was still
+            # being written when we mapped the file. The file handle
+            # will have the rest of it.
+            #
+            logger.put(5, 'No newline in the mapping, using the file handle')
         self.fh.seek(offset)
         line = self.fh.readline()
         offset = self.fh.tell()
         logger.put(5, '<LogFile.get_line_at_offset')
         return [line, offset]
 
+    def get_lines_at_offset(self, offset, limit, maxlines):
+        """
+        Get up to maxlines lines starting at the specified offset. The
+        first line is always returned, just as with get_line_at_offset,
+        but no further lines starting at or past the limit offset are.
+        Returns the list of lines and the offset following the last one.
+        """
+        logger = self.logger
+        logger.put(5, '>LogFile.get_lines_at_offset')
+        lines = []
+        mm = self.mm
+        if mm is not None:
+            find = mm.find
+            while len(lines) < maxlines and (not lines or offset < limit):
+                end = find('\n', offset)
+                if end == -1: break
+                end += 1
+                lines.append(mm[offset:end])
+                offset = end
+            if lines:
+                logger.put(5, '<LogFile.get_lines_at_offset')
+                return [lines, offset]
+            logger.put(5, 'No newline in the mapping, using the file handle')
+        self.fh.seek(offset)
+        readline = self.fh.readline
+        while len(lines) < maxlines and (not lines or offset < limit):
+            line = readline()
+            if not line: break
+            lines.append(line)
+            offset += len(line)
+        logger.put(5, '<LogFile.get_lines_at_offset')
+        return [lines, offset]
+
     def find_previous_entry_by_re(self, offset, regex, limit=1000):
         """
         Back up one line at a time and try to locate the one that
@@ -1120,10 +2611,14 @@ class LogFile:
         """
         logger = self.logger
         logger.put(5, '>LogFile.find_previous_entry_by_re')
-        self.fh.seek(offset)
         count = 0
         while 1:
-            line = self._lineback()
+            if offset <= 1:
+                logger.put(3, 'Start of file reached')
+                raise IOError
+            start, end = find_line_start(self.fh, offset - 2, self.mm)
+            line = self._get_span(start, end)
+            offset = start
             if regex.search(line):
                 logger.put(5, 'Found line: %s' % line)
                 break
@@ -1133,8 +2628,9 @@ class LogFile:
                 logger.put(5, 'Reached backstepping limit')
                 msg = 'Out of sane range looking for line'
                 raise epylog.OutOfRangeError(msg, logger)
+        self.fh.seek(offset)
         logger.put(5, '<LogFile.find_previous_entry_by_re')
-        return line, self.fh.tell()
+        return line, offset
 
     def _crude_locate(self, stamp):
         """
@@ -1282,12 +2778,14 @@ class LogFile:
         """
         logger = self.logger
         logger.put(5, '>LogFile._lineback')
-        #self._set_at_line_start()
-        if self.fh.tell() <= 1:
+        offset = self.fh.tell()
+        if offset <= 1:
             logger.put(3, 'Start of file reached')
             raise IOError
-        entry = self._rel_position(-2)
-        logger.put(5, 'New offset at %d' % self.fh.tell())
+        start, end = find_line_start(self.fh, offset - 2, self.mm)
+        entry = self._get_span(start, end)
+        self.fh.seek(start)
+        logger.put(5, 'New offset at %d' % start)
         logger.put(5, '<LogFile._lineback')
         return entry
 
@@ -1373,6 +2871,14 @@ class LogFile:
                                      % logfile, logger)
         logger.put(5, '<LogFile._accesscheck')
 
+    def _get_span(self, start, end):
+        """
+        Return the contents of the file between two offsets.
+        """
+        if self.mm is not None: return self.mm[start:end]
+        self.fh.seek(start)
+        return self.fh.read(end - start)
+
     def _set_at_line_start(self):
         """
         Position ourselves at the beginning of the line.
@@ -1383,27 +2889,170 @@ class LogFile:
         if orig_offset == 0:
             logger.put(5, 'Already at file start')
             return
-        logger.put(5, 'starting the backstepping loop')
-        entry = ''
-        while 1:
-            curchar = self.fh.read(1)
-            if curchar == '\n':
-                logger.put(5, 'Found newline at offset %d' % self.fh.tell())
-                break
-            #logger.put(5, 'curchar=%s' % curchar)
-            entry = curchar + entry
-            offset = self.fh.tell() - 1
-            self.fh.seek(offset)
-            if offset == 0:
-                logger.put(3, 'Beginning of file reached!')
-                break
-            offset = offset - 1
-            self.fh.seek(offset)
-        logger.put(5, 'Exited the backstepping loop')
-        now_offset = self.fh.tell()
-        rewound = orig_offset - now_offset
-        logger.put(5, 'Line start found at offset "%d"' % now_offset)
-        logger.put(5, 'rewound by %d characters' % rewound)
+        start, end = find_line_start(self.fh, orig_offset, self.mm)
+        entry = self._get_span(start, end)
+        if entry[-1:] == '\n': entry = entry[:-1]
+        self.fh.seek(start)
+        logger.put(5, 'Line start found at offset "%d"' % start)
+        logger.put(5, 'rewound by %d characters' % (orig_offset - start))
         logger.put(5, '<LogFile._set_at_line_start')
         return entry
-        
+
+class GzipLogReader:
+    """
+    A read-only, seekable file-like object over a gzipped logfile, so
+    rotated logs can be used without inflating them into a tempfile first.
+    Data is inflated as it is read. Every GZIP_CHECKPOINT bytes of output
+    a copy of the decompressor state is kept, so seeking backwards only
+    needs to inflate from the nearest checkpoint instead of the start.
+    """
+    def __init__(self, filename, logger, spacing=None):
+        self.logger = logger
+        logger.put(5, '>GzipLogReader.__init__')
+        self.name = filename
+        if spacing is None: spacing = epylog.GZIP_CHECKPOINT
+        self.spacing = spacing
+        self.gzfh = open(filename, 'rb')
+        ##
+        # checkpoints: list of (outpos, inpos, decompressor) tuples
+        # cpoffsets:   the outpos members, for bisecting
+        # size:        total inflated size, once we know it
+        #
+        self.checkpoints = []
+        self.cpoffsets = []
+        self.size = None
+        self.pos = 0
+        self._rewind()
+        ##
+        # Make sure this is actually gzipped.
+        #
+        self._inflate()
+        logger.put(5, '<GzipLogReader.__init__')
+
+    def _rewind(self):
+        """
+        Start inflating from the very beginning of the file.
+        """
+        self.gzfh.seek(0)
+        self.dobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buf = ''
+        self.bufstart = 0
+        self.outpos = 0
+        self.eof = 0
+
+    def _restore(self, offset):
+        """
+        Restart inflating from the last checkpoint before the offset.
+        """
+        logger = self.logger
+        ix = bisect.bisect_right(self.cpoffsets, offset) - 1
+        if ix < 0:
+            logger.put(5, 'Rewinding "%s" to the start' % self.name)
+            self._rewind()
+            return
+        outpos, inpos, dobj = self.checkpoints[ix]
+        logger.put(5, 'Restoring "%s" from checkpoint at %d'
+                   % (self.name, outpos))
+        self.gzfh.seek(inpos)
+        self.dobj = dobj.copy()
+        self.buf = ''
+        self.bufstart = outpos
+        self.outpos = outpos
+        self.eof = 0
+
+    def _inflate(self):
+        """
+        Inflate the next chunk of the file and add it to the buffer.
+        Returns the number of bytes added, 0 at the end of file.
+        """
+        if self.eof: return 0
+        ##
+        # Only keep a little bit of what is behind us, for stepping back
+        # to the start of the line.
+        #
+        keep = self.pos - epylog.CHUNK_SIZE
+        if keep > self.bufstart:
+            cut = min(keep - self.bufstart, len(self.buf))
+            self.buf = self.buf[cut:]
+            self.bufstart += cut
+        chunk = self.gzfh.read(epylog.CHUNK_SIZE * 8)
+        if not chunk:
+            self.eof = 1
+            self.size = self.outpos
+            return 0
+        data = self.dobj.decompress(chunk)
+        while self.dobj.unused_data:
+            ##
+            # Concatenated gzip members
+            #
+            rest = self.dobj.unused_data
+            self.dobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                data += self.dobj.decompress(rest)
+            except zlib.error:
+                ##
+                # Trailing garbage, just like GzipFile, ignore it.
+                #
+                self.gzfh.seek(0, 2)
+                break
+        self.buf += data
+        self.outpos += len(data)
+        if (hasattr(self.dobj, 'copy') and self.outpos >= self.spacing and
+            (not self.cpoffsets or
+             self.outpos - self.cpoffsets[-1] >= self.spacing)):
+            self.checkpoints.append((self.outpos, self.gzfh.tell(),
+                                     self.dobj.copy()))
+            self.cpoffsets.append(self.outpos)
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        if whence == 1: offset = self.pos + offset
+        elif whence == 2:
+            while self._inflate(): pass
+            offset = self.size + offset
+        if offset < 0: offset = 0
+        if offset < self.bufstart: self._restore(offset)
+        self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        if size < 0:
+            while self._inflate(): pass
+            end = self.outpos
+        else:
+            end = self.pos + size
+            while self.outpos < end and self._inflate(): pass
+        data = self.buf[self.pos - self.bufstart:end - self.bufstart]
+        self.pos += len(data)
+        return data
+
+    def readline(self):
+        start = self.pos - self.bufstart
+        while 1:
+            ix = self.buf.find('\n', start)
+            if ix != -1 or not self._inflate(): break
+            ##
+            # _inflate may have trimmed the buffer from the front
+            #
+            start = self.pos - self.bufstart
+        if ix == -1: line = self.buf[self.pos - self.bufstart:]
+        else: line = self.buf[self.pos - self.bufstart:ix + 1]
+        self.pos += len(line)
+        return line
+
+    def reopen(self):
+        """
+        Open the gzipped file again, so this reader does not share the
+        file position with a forked process.
+        """
+        self.gzfh.close()
+        self.gzfh = open(self.name, 'rb')
+        self._restore(self.pos)
+
+    def close(self):
+        self.gzfh.close()
+        self.buf = ''
+        self.checkpoints = []
+        self.cpoffsets = []
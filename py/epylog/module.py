@@ -32,6 +32,8 @@ import os
 import tempfile
 import string
 import re
+import sre_parse
+import threading
 
 if 'mkdtemp' not in dir(tempfile):
     ##
@@ -43,6 +45,294 @@ if 'mkdtemp' not in dir(tempfile):
 from ihooks import BasicModuleLoader
 _loader = BasicModuleLoader()
 
+from log import load_state, REGEXSTATS_FILE
+
+def _longest_literal(items):
+    """
+    Return the longest run of literal characters in the parsed items
+    that anything they match has to contain.
+    """
+    runs = []
+    run = []
+    ##
+    # Groups are matched in sequence with whatever surrounds them, so
+    # they are walked as if they were not there. Anything else that is
+    # not a plain character ends the run.
+    #
+    stack = [list(items)]
+    while stack:
+        items = stack[-1]
+        if not items:
+            stack.pop()
+            continue
+        op, av = items.pop(0)
+        if op == sre_parse.LITERAL:
+            run.append(chr(av))
+        elif op == sre_parse.SUBPATTERN:
+            stack.append(list(av[-1]))
+        else:
+            runs.append(''.join(run))
+            run = []
+    runs.append(''.join(run))
+    literal = ''
+    for candidate in runs:
+        if len(candidate) > len(literal): literal = candidate
+    return literal
+
+def required_literals(regex):
+    """
+    Find the longest run of literal characters that anything matched by
+    the compiled regex has to contain. For a regex made of alternatives,
+    find one for each alternative: anything matched contains one of
+    them. Returns a (literals, icase) tuple, where icase is 1 if the
+    regex ignores case, in which case the literals are in lowercase.
+    The literals are an empty tuple if there is not a run of at least
+    PREFILTER_MIN characters for every alternative.
+    """
+    try:
+        pattern = regex.pattern
+        flags = regex.flags
+    except AttributeError:
+        return ((), 0)
+    icase = flags & re.IGNORECASE and 1 or 0
+    if not isinstance(pattern, str) or (icase and
+                                        flags & (re.LOCALE | re.UNICODE)):
+        return ((), 0)
+    try: parsed = list(sre_parse.parse(pattern, flags))
+    except Exception: return ((), 0)
+    while len(parsed) == 1 and parsed[0][0] == sre_parse.SUBPATTERN:
+        parsed = list(parsed[0][1][-1])
+    if len(parsed) == 1 and parsed[0][0] == sre_parse.BRANCH:
+        alternatives = parsed[0][1][1]
+    else:
+        alternatives = [parsed]
+    literals = {}
+    for items in alternatives:
+        literal = _longest_literal(items)
+        if len(literal) < epylog.PREFILTER_MIN: return ((), 0)
+        if icase: literal = literal.lower()
+        literals[literal] = 1
+    literals = literals.keys()
+    literals.sort()
+    return (tuple(literals), icase)
+
+def required_tag(regex):
+    """
+    If the compiled regex can only match messages starting with a given
+    program tag, e.g. "^sshd\[", return the tag. Otherwise return None.
+    """
+    try:
+        pattern = regex.pattern
+        flags = regex.flags
+    except AttributeError:
+        return None
+    if flags & (re.IGNORECASE | re.MULTILINE): return None
+    try: parsed = list(sre_parse.parse(pattern, flags))
+    except Exception: return None
+    if not parsed or parsed[0] != (sre_parse.AT, sre_parse.AT_BEGINNING):
+        return None
+    run = []
+    for op, av in parsed[1:]:
+        if op != sre_parse.LITERAL: break
+        run.append(chr(av))
+    ##
+    # The tag must be followed by whatever ends it in the message,
+    # otherwise "^sshd" would be taken for lines from "sshd-keygen".
+    #
+    for i in range(len(run)):
+        if run[i] in epylog.PROGRAM_TAG_END:
+            if i: return ''.join(run[:i])
+            break
+    return None
+
+def shape_sensitive(regex):
+    """
+    Tell if the compiled regex can match one message and not another
+    that only differs from it in the digits, i.e. if it has a literal
+    digit, a character class with only some of the digits, or a
+    backreference. Messages are given to the match cache with their
+    digits masked, so its answers only hold for regexes that are not.
+    """
+    try: parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception: return 1
+    digits = range(ord('0'), ord('9') + 1)
+    stack = [parsed]
+    while stack:
+        for op, av in stack.pop():
+            if op in (sre_parse.LITERAL, sre_parse.NOT_LITERAL):
+                if av in digits: return 1
+            elif op == sre_parse.IN:
+                ##
+                # Categories like \d or \w take all digits or none of
+                # them, so only look at the single characters and ranges.
+                #
+                covered = {}
+                for iop, iav in av:
+                    if iop == sre_parse.LITERAL:
+                        covered[iav] = 1
+                    elif iop == sre_parse.RANGE:
+                        for code in digits:
+                            if iav[0] <= code <= iav[1]: covered[code] = 1
+                    elif iop not in (sre_parse.NEGATE, sre_parse.CATEGORY):
+                        return 1
+                hits = 0
+                for code in digits:
+                    if code in covered: hits += 1
+                if hits not in (0, len(digits)): return 1
+            elif op == sre_parse.BRANCH:
+                stack.extend(av[1])
+            elif op in (sre_parse.SUBPATTERN, sre_parse.ASSERT,
+                        sre_parse.ASSERT_NOT, sre_parse.MAX_REPEAT,
+                        sre_parse.MIN_REPEAT):
+                stack.append(av[-1])
+            elif op not in (sre_parse.AT, sre_parse.ANY):
+                return 1
+    return 0
+
+class MatchCache:
+    """
+    Remembers, by the shape of a message, i.e. with its digits masked,
+    what regexes of what modules matched it, or that none did. Lines
+    differing only in their PIDs, addresses, ports and the like then
+    only need the regexes that matched to be run again, for the match
+    objects. It is kept in two generations: when the current one is
+    full, the previous one is dropped, and whatever was found in it is
+    moved to the current one, so the shapes not seen in a while go.
+    """
+    def __init__(self, size, logger):
+        self.logger = logger
+        logger.put(5, '>MatchCache.__init__')
+        self.size = max(size / 2, 1)
+        self.current = {}
+        self.previous = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        logger.put(5, '<MatchCache.__init__')
+
+    def get(self, shape):
+        """
+        Return what was put for this shape, or None if it is not known.
+        """
+        matches = self.current.get(shape)
+        if matches is None:
+            matches = self.previous.get(shape)
+            if matches is None:
+                self.misses += 1
+                return None
+            del self.previous[shape]
+            self._store(shape, matches)
+        self.hits += 1
+        return matches
+
+    def put(self, shape, matches):
+        """
+        Remember the matches for a shape: a tuple with the regex that
+        matched, or None, for each module tried in turn.
+        """
+        self._store(shape, matches)
+
+    def drop(self, shape):
+        """
+        Forget a shape.
+        """
+        if shape in self.current: del self.current[shape]
+        if shape in self.previous: del self.previous[shape]
+
+    def clear(self):
+        """
+        Forget all shapes, e.g. when the modules changed the order of
+        their regexes.
+        """
+        self.current = {}
+        self.previous = {}
+
+    def _store(self, shape, matches):
+        if len(self.current) >= self.size:
+            self.evictions += len(self.previous)
+            self.previous = self.current
+            self.current = {}
+        self.current[shape] = matches
+
+class Prefilter:
+    """
+    Finds the literal strings required by the regexes of the internal
+    modules in a message, all in one pass. Regexes none of whose literals
+    are in the message cannot match it and need not be tried. It also finds
+    the program tag of the message, for the regexes that only apply to
+    lines from certain programs.
+    """
+    def __init__(self, modules, logger):
+        self.logger = logger
+        logger.put(5, '>Prefilter.__init__')
+        literals = {}
+        iliterals = {}
+        ##
+        # Only look for the program tag if some regex is dispatched by it.
+        #
+        self.tagged = 0
+        for module in modules:
+            if getattr(module, 'tag_index', None): self.tagged = 1
+            for regex, handler, fieldspec, rliterals, icase in \
+                    module.match_list:
+                for literal in rliterals:
+                    if icase: iliterals[literal] = 1
+                    else: literals[literal] = 1
+        self.literal_re, self.implied = self._compile(literals.keys())
+        self.iliteral_re, self.iimplied = self._compile(iliterals.keys())
+        logger.put(3, 'Prefilter looks for %d literals'
+                   % (len(literals) + len(iliterals)))
+        logger.put(5, '<Prefilter.__init__')
+
+    def _compile(self, literals):
+        """
+        Make a regex that finds any of the literals. At each position
+        only the longest literal that matches is found, so keep a map of
+        the literals each one contains.
+        """
+        if not literals: return (None, {})
+        literals.sort(lambda a, b: cmp(len(b), len(a)))
+        implied = {}
+        for literal in literals:
+            implied[literal] = []
+            for other in literals:
+                if other in literal: implied[literal].append(other)
+        escaped = []
+        for literal in literals: escaped.append(re.escape(literal))
+        regex = re.compile('|'.join(escaped))
+        return (regex, implied)
+
+    def _find(self, regex, implied, message, found):
+        """
+        Put all literals found by the regex in the message into found.
+        Searching again right after the start of every match, instead of
+        after its end, catches the literals that overlap.
+        """
+        search = regex.search
+        match = search(message)
+        while match is not None:
+            for literal in implied[match.group()]: found[literal] = 1
+            match = search(message, match.start() + 1)
+
+    def scan(self, message):
+        """
+        Return the literals and the program tag found in the message, to
+        be passed on to Module.message_match. The tag is None if no
+        regex needs it.
+        """
+        found = {}
+        if self.literal_re is not None:
+            self._find(self.literal_re, self.implied, message, found)
+        ifound = {}
+        if self.iliteral_re is not None:
+            self._find(self.iliteral_re, self.iimplied, message.lower(),
+                       ifound)
+        tag = None
+        if self.tagged:
+            match = epylog.PROGRAM_TAG_RE.match(message)
+            if match is not None: tag = match.group()
+        return (found, ifound, tag)
+
 class Module:
     """epylog Module class"""
     
@@ -85,12 +375,10 @@ class Module:
                 self.extraopts[option] = value
             logger.put(5, 'Done with extra options')
 
-        modname = os.path.basename(self.executable)
-        tempfile.tempdir = tmpprefix
         self.tmpprefix = tmpprefix
-        self.logdump = tempfile.mktemp('%s.DUMP' % modname)
-        self.logreport = tempfile.mktemp('%s.REPORT' % modname)
-        self.logfilter = tempfile.mktemp('%s.FILTER' % modname)
+        self.vardir = logtracker.vardir
+        self.filtlock = threading.Lock()
+        self._mk_tempnames()
 
         logger.put(5, 'name=%s' % self.name)
         logger.put(5, 'executable=%s' % self.executable)
@@ -104,9 +392,10 @@ class Module:
         logger.put(5, 'logfilter=%s' % self.logfilter)
 
         ##
-        # Init internal modules
+        # Internal modules are imported and initialized by load(), once
+        # their logs are known to have something to process.
         #
-        if self.internal: self._init_internal_module()
+        if self.internal: self._unload_internal_module()
         
         logger.put(3, 'Figuring out the logfiles from the log list')
         entrylist = logentries.split(',')
@@ -149,6 +438,47 @@ class Module:
             self.logger.put(5, 'This module is not internal')
             return 0
 
+    def restart(self):
+        """
+        Get ready to process the logs all over again. This happens when
+        epylog is following the logs and starts on the next report.
+        """
+        logger = self.logger
+        logger.put(5, '>Module.restart')
+        for filename in self.tempfiles:
+            if os.path.exists(filename):
+                logger.put(3, 'Removing "%s"' % filename)
+                os.unlink(filename)
+        self._mk_tempnames()
+        if self.internal: self._unload_internal_module()
+        logger.put(5, '<Module.restart')
+
+    def load(self):
+        """
+        Import and initialize an internal module, unless it already is.
+        """
+        if self.epymod is None: self._init_internal_module()
+
+    def _unload_internal_module(self):
+        """
+        Forget about the imported internal module, until load() is called.
+        """
+        self.epymod = None
+        self.filtfh = None
+        self.match_list = []
+        self.batch_map = {}
+
+    def _mk_tempnames(self):
+        """
+        Make up the names of the temporary files for this module.
+        """
+        modname = os.path.basename(self.executable)
+        tempfile.tempdir = self.tmpprefix
+        self.logdump = tempfile.mktemp('%s.DUMP' % modname)
+        self.logreport = tempfile.mktemp('%s.REPORT' % modname)
+        self.logfilter = tempfile.mktemp('%s.FILTER' % modname)
+        self.tempfiles = [self.logdump, self.logreport, self.logfilter]
+
     def _init_internal_module(self):
         """
         Initializes an internal module by importing it and running
@@ -174,42 +504,239 @@ class Module:
         logger.endhang(3)
         try:
             modclass = getattr(module, modname)
+            epylog.InternalModule.vardir = self.vardir
             self.epymod = modclass(self.extraopts, logger)
         except AttributeError:
             msg = 'Could not instantiate class "%s" in module "%s"'
             msg = msg % (modname, self.executable)
             raise epylog.ModuleError(msg, logger)
+        logger.put(3, 'Finding the literals required by the regexes')
+        ##
+        # match_list:    (regex, handler, fieldspec, literals, icase) in the
+        #                order the regexes are tried. Handlers in regex_map
+        #                may come with a fieldspec, as (handler, fieldspec).
+        # regex_tags:    the program tags of the regexes that only apply
+        #                to lines from certain programs
+        # hits:          how many lines each regex matched in this run,
+        #                only counted if the module is order safe
+        # stored_hits:   the same, as stored by the previous runs
+        # shape_sensitive: the regexes for which shape_sensitive() is true
+        # batch_map:     the regexes whose lines go to a batch handler
+        #
+        self.match_list = []
+        self.regex_tags = {}
+        self.shape_sensitive = {}
+        self.hits = {}
+        self.stored_hits = {}
+        tag_map = getattr(self.epymod, 'tag_map', {})
+        self.batch_map = getattr(self.epymod, 'batch_map', {})
+        ##
+        # A module that cares which of its regexes is tried first can
+        # list them in that order in .regex_order.
+        #
+        regexes = getattr(self.epymod, 'regex_order', None)
+        if not regexes: regexes = self.epymod.regex_map.keys()
+        for regex in regexes:
+            handler = self.epymod.regex_map[regex]
+            if shape_sensitive(regex): self.shape_sensitive[regex] = 1
+            fieldspec = None
+            if isinstance(handler, tuple): handler, fieldspec = handler
+            tags = tag_map.get(regex) or required_tag(regex)
+            if tags:
+                if isinstance(tags, str): tags = (tags,)
+                self.regex_tags[regex] = tags
+                self.match_list.append((regex, handler, fieldspec, (), 0))
+                continue
+            literals, icase = required_literals(regex)
+            self.match_list.append((regex, handler, fieldspec, literals,
+                                    icase))
+        self._index_match_list()
+        self.order_safe = getattr(self.epymod, 'regex_order_safe', 0)
+        if self.order_safe:
+            logger.put(3, 'Ordering the regexes by the stored hits')
+            stats = load_state(self.vardir, REGEXSTATS_FILE, logger)
+            try: self.stored_hits = stats[self.executable][0]
+            except (KeyError, TypeError, IndexError): pass
+            self.reorder()
         logger.put(3, 'Opening "%s" for writing' % self.logfilter)
         self.filtfh = open(self.logfilter, 'w+')
         logger.put(5, '<Module._init_internal_module')
 
-    def message_match(self, message):
+    def _index_match_list(self):
+        """
+        Work out where in match_list the regexes are, by program tag and
+        by literal, for message_match to pick the candidates quickly.
+        """
+        ##
+        # tag_index:     for program tags, where in match_list are the
+        #                regexes that only apply to lines from them
+        # literal_index: for case-sensitive and case-insensitive literals,
+        #                where in match_list are the regexes needing them
+        # alternatives:  if some regexes need one of several literals, and
+        #                so can be found more than once in literal_index
+        # unfiltered:    where are the regexes without a tag or a literal
+        # regex_index:   where in match_list is each regex
+        # sensitive:     where are the regexes that tell messages of the
+        #                same shape apart, see shape_sensitive()
+        #
+        self.tag_index = {}
+        self.literal_index = ({}, {})
+        self.unfiltered = []
+        self.alternatives = 0
+        self.regex_index = {}
+        self.sensitive = []
+        for ix in range(len(self.match_list)):
+            regex, handler, fieldspec, literals, icase = self.match_list[ix]
+            self.regex_index[regex] = ix
+            if regex in self.shape_sensitive: self.sensitive.append(ix)
+            tags = self.regex_tags.get(regex)
+            if tags:
+                for tag in tags: self.tag_index.setdefault(tag, []).append(ix)
+            elif not literals: self.unfiltered.append(ix)
+            else:
+                if len(literals) > 1: self.alternatives = 1
+                index = self.literal_index[icase]
+                for literal in literals:
+                    index.setdefault(literal, []).append(ix)
+
+    def reorder(self):
+        """
+        Try the regexes that match most often first. Only done if the
+        module says it does not matter which of its regexes matches a
+        line first. Returns 1 if the order changed.
+        """
+        if not self.order_safe: return 0
+        logger = self.logger
+        logger.put(5, '>Module.reorder')
+        decorated = []
+        for ix in range(len(self.match_list)):
+            entry = self.match_list[ix]
+            regex = entry[0]
+            key = (regex.pattern, regex.flags)
+            hits = self.hits.get(regex, 0) + self.stored_hits.get(key, 0)
+            decorated.append((-hits, ix, entry))
+        decorated.sort()
+        match_list = []
+        for hits, ix, entry in decorated: match_list.append(entry)
+        changed = match_list != self.match_list
+        if changed:
+            self.match_list = match_list
+            self._index_match_list()
+        logger.put(5, '<Module.reorder')
+        return changed
+
+    def get_hits(self):
+        """
+        Return how many lines each regex matched, by (pattern, flags), so
+        they can be stored or passed between processes.
+        """
+        hits = {}
+        for regex, count in self.hits.items():
+            hits[(regex.pattern, regex.flags)] = count
+        return hits
+
+    def add_hits(self, hits):
+        """
+        Add the hits returned by get_hits() in another process.
+        """
+        for entry in self.match_list:
+            regex = entry[0]
+            count = hits.get((regex.pattern, regex.flags))
+            if count: self.hits[regex] = self.hits.get(regex, 0) + count
+
+    def message_match(self, message, found=None):
         """
         Used by internal modules to match the message of a syslog entry
-        against the list of regexes in the .regex_map.
+        against the list of regexes in the .regex_map. Returns the
+        handler, the match object and the fieldspec of the first regex
+        that matches, or Nones. If "found" is what Prefilter.scan
+        returned for the message, regexes requiring a literal that is not
+        in it, or meant for other programs, are skipped.
         """
         logger = self.logger
         logger.put(5, '>Module.message_match')
         handler = None
-        match_regex = None
-        for regex in self.epymod.regex_map.keys():
-            if regex.search(message):
+        match = None
+        fieldspec = None
+        match_list = self.match_list
+        if found is None:
+            candidates = range(len(match_list))
+        else:
+            candidates = self.unfiltered[:]
+            for icase in (0, 1):
+                index = self.literal_index[icase]
+                for literal in found[icase]:
+                    if literal in index: candidates.extend(index[literal])
+            if found[2] in self.tag_index:
+                candidates.extend(self.tag_index[found[2]])
+            candidates.sort()
+            if self.alternatives:
+                unique = []
+                last = None
+                for ix in candidates:
+                    if ix != last: unique.append(ix)
+                    last = ix
+                candidates = unique
+        for ix in candidates:
+            regex, rhandler, rfieldspec, literals, icase = match_list[ix]
+            match = regex.search(message)
+            if match is not None:
+                if self.order_safe:
+                    self.hits[regex] = self.hits.get(regex, 0) + 1
                 logger.put(5, 'match: %s' % message)
                 logger.put(5, 'matching module: %s' % self.name)
-                match_regex = regex
-                handler = self.epymod.regex_map[regex]
+                handler = rhandler
+                fieldspec = rfieldspec
                 break
         logger.put(5, '<Module.message_match')
-        return (handler, match_regex)
+        return (handler, match, fieldspec)
 
-    def put_filtered(self, line):
+    def shape_match(self, message, regex):
         """
-        Puts a filtered line into the file with all filtered lines.
+        Like message_match, for a message of a shape that the match
+        cache knows "regex" (or None, for no regex) to be the first to
+        match. Only the regexes before it that can tell messages of the
+        same shape apart are tried, and then the regex itself.
+        """
+        logger = self.logger
+        logger.put(5, '>Module.shape_match')
+        match_list = self.match_list
+        if regex is None: stop = len(match_list)
+        else: stop = self.regex_index[regex]
+        candidates = []
+        for ix in self.sensitive:
+            if ix >= stop: break
+            candidates.append(ix)
+        if regex is not None: candidates.append(stop)
+        for ix in candidates:
+            regex, handler, fieldspec, literals, icase = match_list[ix]
+            match = regex.search(message)
+            if match is not None:
+                if self.order_safe:
+                    self.hits[regex] = self.hits.get(regex, 0) + 1
+                logger.put(5, '<Module.shape_match')
+                return (handler, match, fieldspec)
+        if stop < len(match_list):
+            ##
+            # Should not happen, but the full match is always right.
+            #
+            logger.put(2, 'Cached regex did not match: %s' % message)
+            logger.put(5, '<Module.shape_match')
+            return self.message_match(message)
+        logger.put(5, '<Module.shape_match')
+        return (None, None, None)
+
+    def put_filtered(self, lines):
+        """
+        Puts filtered lines into the file with all filtered lines. The
+        processing threads may call this at the same time.
         """
         logger = self.logger
         logger.put(5, '>Module.put_filtered')
-        self.filtfh.write(line)
-        logger.put(3, 'Wrote "%s" into filtfh' % line)
+        self.filtlock.acquire()
+        try: self.filtfh.writelines(lines)
+        finally: self.filtlock.release()
+        logger.put(3, 'Wrote %d lines into filtfh' % len(lines))
         logger.put(5, '<Module.put_filtered')
 
     def no_report(self):
@@ -219,7 +746,7 @@ class Module:
         self.logger.put(5, '>Module.no_report')
         self.logreport = None
         self.logfilter = None
-        self.close_filtered()
+        if self.filtfh is not None: self.close_filtered()
         self.logger.put(5, '<Module.no_report')
         
     def close_filtered(self):
@@ -258,7 +785,7 @@ class Module:
             self.logfilter = None
         self.close_filtered()
         logger.put(3, 'Done with this module, deleting')
-        del self.epymod
+        self.epymod = None
         logger.put(5, '<Module.finalize_processing')
     
     def invoke_external_module(self, cfgdir):